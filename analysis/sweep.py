@@ -0,0 +1,181 @@
+import argparse
+import glob
+import itertools
+import json
+import os
+import shlex
+import subprocess
+import time
+
+import yaml
+
+parser = argparse.ArgumentParser(description='Run every combination of a sweep config, several at a time within a core budget.')
+parser.add_argument('config', type=str, help='YAML file with the script, the shared settings and the sweep.')
+parser.add_argument('--cores', default=None, type=int, help='Cores the runs may use together, the config or every core of the machine by default.')
+parser.add_argument('--rerun', default=False, action=argparse.BooleanOptionalAction, help='Run combinations again even when they already finished.')
+parser.add_argument('--dry_run', action='store_true', help='Only print the runs and whether they would be skipped.')
+
+# Written into the data path of every run, the sweep reads it back to skip
+# the runs that finished.
+STATUS_FILE = "sweep.json"
+OUTPUT_FILE = "sweep.log"
+POLL_SECONDS = 1.0
+
+
+def combinations(sweep):
+    # The sweep is a list of axes. Every axis maps flags to lists of values
+    # that change together, and the runs are the product of the axes.
+    axes = []
+    for axis in sweep or []:
+        lengths = {len(values) for values in axis.values()}
+        if len(lengths) != 1:
+            raise ValueError(f"Flags of one sweep axis need the same number of values: {axis}")
+        axes.append([dict(zip(axis, values)) for values in zip(*axis.values())])
+    for product in itertools.product(*axes):
+        parameters = {}
+        for values in product:
+            parameters.update(values)
+        yield parameters
+
+
+def run_path(data_path, parameters):
+    # One directory per run, nested in the order of the sweep, so results are
+    # found by their parameters and runs never share their outputs.
+    return os.path.join(data_path, *(f"{name}-{value}" for name, value in parameters.items()))
+
+
+def flags(settings):
+    arguments = []
+    for name, value in settings.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            arguments.append(f"--{name}" if value else f"--no-{name}")
+        else:
+            arguments += [f"--{name}", str(value)]
+    return arguments
+
+
+def read_status(path):
+    try:
+        with open(os.path.join(path, STATUS_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_status(path, status):
+    # Written to a temporary file and renamed, so a crash never leaves a
+    # half written status behind.
+    filename = os.path.join(path, STATUS_FILE)
+    with open(filename + ".tmp", "w") as f:
+        json.dump(status, f, indent=2)
+    os.replace(filename + ".tmp", filename)
+
+
+class Run:
+    def __init__(self, config, parameters):
+        self.parameters = parameters
+        self.settings = {**config.get("settings", {}), **parameters}
+        self.path = run_path(os.path.expanduser(config["data_path"]), parameters)
+        launcher = shlex.split(config.get("launcher", "").format(**self.settings))
+        self.command = launcher + [config.get("python_path", "python"), config["python_file"]] + flags(
+            {**self.settings, "data_path": self.path}
+        )
+        # Every MPI process, and every thread of it, takes a core
+        processes = self.settings.get("number_of_processes", 1) if launcher else 1
+        self.cores = processes * self.settings.get("threads_per_rank", 1)
+        self.process = None
+        self.output = None
+        self.start_time = None
+
+    def same_settings(self):
+        # Results only count for the settings they were run with, a change to
+        # the shared settings runs the combination again from scratch.
+        status = read_status(self.path)
+        return status is not None and status.get("settings") == self.settings
+
+    def finished(self):
+        return self.same_settings() and read_status(self.path)["status"] == "done"
+
+    def start(self):
+        os.makedirs(self.path, exist_ok=True)
+        # A run that was cut short picks up from its latest checkpoint
+        command = self.command
+        if self.same_settings() and glob.glob(
+            os.path.join(self.path, "checkpoint", "**", "manifest.json"), recursive=True
+        ):
+            command = command + ["--resume"]
+        self.output = open(os.path.join(self.path, OUTPUT_FILE), "a")
+        self.start_time = time.time()
+        self.process = subprocess.Popen(command, stdout=self.output, stderr=subprocess.STDOUT)
+        self.write("running", command)
+
+    def poll(self):
+        returncode = self.process.poll()
+        if returncode is None:
+            return False
+        self.output.close()
+        self.write("done" if returncode == 0 else "failed", self.process.args, returncode)
+        return True
+
+    def write(self, status, command, returncode=None):
+        write_status(self.path, {
+            "status": status,
+            "parameters": self.parameters,
+            "settings": self.settings,
+            "command": command,
+            "cores": self.cores,
+            "returncode": returncode,
+            "start_time": self.start_time,
+            "seconds": time.time() - self.start_time,
+        })
+
+
+def schedule(runs, cores):
+    # Starts the largest runs that fit first and fills the cores that are
+    # left with smaller ones. A run larger than the budget runs on its own.
+    pending = sorted(runs, key=lambda run: run.cores, reverse=True)
+    running = []
+    try:
+        while pending or running:
+            free = cores - sum(run.cores for run in running)
+            for run in list(pending):
+                if run.cores <= free or not running:
+                    pending.remove(run)
+                    run.start()
+                    running.append(run)
+                    free -= run.cores
+                    print(f"Started {run.path} on {run.cores} cores", flush=True)
+            time.sleep(POLL_SECONDS)
+            for run in [run for run in running if run.poll()]:
+                running.remove(run)
+                print(f"{'Finished' if run.process.returncode == 0 else 'Failed'} {run.path} "
+                      f"after {time.time() - run.start_time:.1f} seconds", flush=True)
+    finally:
+        # Runs cut short by an interrupted sweep are marked failed and resume
+        # from their checkpoint next time.
+        for run in running:
+            run.process.terminate()
+            run.process.wait()
+            run.poll()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    cores = args.cores or config.get("cores") or os.cpu_count()
+
+    runs = [Run(config, parameters) for parameters in combinations(config.get("sweep"))]
+    todo = [run for run in runs if args.rerun or not run.finished()]
+    print(f"{len(runs)} runs, {len(runs) - len(todo)} already finished, {cores} cores", flush=True)
+    if args.dry_run:
+        for run in runs:
+            print(f"{'run ' if run in todo else 'skip'} {run.cores:>3} cores  {shlex.join(run.command)}")
+    else:
+        schedule(todo, cores)
+        failed = [run.path for run in runs if not run.finished()]
+        print(f"{len(runs) - len(failed)} of {len(runs)} runs finished", flush=True)
+        for path in failed:
+            print(f"Failed: {path}, see {os.path.join(path, OUTPUT_FILE)}")
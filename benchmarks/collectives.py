@@ -0,0 +1,68 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from mpi4py import MPI
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from communication import BufferedCollectives, PickleCollectives
+from houses import MOVE_DTYPE
+
+parser = argparse.ArgumentParser(description='Compare pickled and buffer based collectives for the per-iteration exchange of run_distributed.py.')
+parser.add_argument('--houses_per_rank', default=1_000_000, type=int, help='Number of houses owned by every worker.')
+parser.add_argument('--moving_ratio', default=0.2, type=float, help='Share of houses that are unsatisfied or empty every iteration.')
+parser.add_argument('--number_of_iterations', default=10, type=int, help='Number of exchanges to time per mode.')
+
+
+def exchange(collectives, movers):
+    # One iteration of the root move path: gather unsatisfied agents and empty
+    # houses on the root, then scatter the moves back. The houses themselves
+    # stay on the workers.
+    unsatisfied, empty = movers
+    gathered_unsatisfied, unsatisfied_counts = collectives.gatherv("unsatisfied", unsatisfied, 2, MOVE_DTYPE)
+    gathered_empty, empty_counts = collectives.gatherv("empty", empty, 2, MOVE_DTYPE)
+    satisfied_out = empty_out = None
+    if gathered_unsatisfied is not None:
+        satisfied_out = np.split(gathered_unsatisfied, np.cumsum(unsatisfied_counts)[:-1])
+        empty_out = np.split(gathered_empty, np.cumsum(empty_counts)[:-1])
+    collectives.scatterv("satisfied", satisfied_out, 2, MOVE_DTYPE)
+    collectives.scatterv("empty", empty_out, 2, MOVE_DTYPE)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+
+    if rank != 0:
+        rng = np.random.default_rng(rank)
+        moving = int(args.houses_per_rank * args.moving_ratio)
+        movers = (
+            rng.integers(0, args.houses_per_rank, (moving // 2, 2), dtype=MOVE_DTYPE),
+            rng.integers(0, args.houses_per_rank, (moving - moving // 2, 2), dtype=MOVE_DTYPE),
+        )
+    else:
+        movers = (None, None)
+
+    results = {}
+    for name, collectives in (
+        ("pickle", PickleCollectives(comm)),
+        ("buffer", BufferedCollectives(comm)),
+    ):
+        exchange(collectives, movers)  # warm up
+        times = []
+        for _ in range(args.number_of_iterations):
+            comm.Barrier()
+            start = time.perf_counter()
+            exchange(collectives, movers)
+            comm.Barrier()
+            times.append(time.perf_counter() - start)
+        results[name] = np.mean(times)
+
+    if rank == 0:
+        for name, seconds in results.items():
+            print(f"{name}: {seconds:.4f} seconds per iteration")
+        print(f"buffer saves {results['pickle'] - results['buffer']:.4f} seconds per iteration "
+              f"({results['pickle'] / results['buffer']:.2f}x)")
@@ -0,0 +1,225 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import geopandas as gp
+import numpy as np
+import scipy
+import shapely
+from shapely.geometry import Point, box
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from partition import partition_data, partition_houses
+from simulation import Simulation
+from utils import generate_points, move_centralized, move_distributed, populate_simulation
+
+PARTITION_KINDS = ["row", "col", "hilbert", "morton", "geohash", "hilbert_balanced", "morton_balanced", "rcb"]
+# Houses sit on a lattice of unit spacing inside the synthetic polygons.
+SPACING = 1.0
+
+parser = argparse.ArgumentParser(description='Time the hot paths of the simulation on synthetic polygons, without MPI or shape files.')
+parser.add_argument('--sizes', default=[10_000, 100_000, 1_000_000, 10_000_000], nargs='+', type=int, help='Approximate numbers of houses to run every case at.')
+parser.add_argument('--shapes', default=["square", "disc"], nargs='+', choices=["square", "disc"], help='Synthetic polygons to fill with houses.')
+parser.add_argument('--engines', default=["kdtree", "lattice"], nargs='+', choices=["kdtree", "lattice"], help='Neighbour counting engines to time.')
+parser.add_argument('--partitions', default=PARTITION_KINDS, nargs='+', choices=PARTITION_KINDS, help='partition_data kinds to time.')
+parser.add_argument('--number_of_partitions', default=4, type=int, help='Number of partitions for the partitioners and move_distributed.')
+parser.add_argument('--partition_max_houses', default=1_000_000, type=int, help='Skip the GeoDataFrame based house partitioners above this many houses.')
+parser.add_argument('--empty_ratio', default=0.1, type=float, help='Empty ratio of the generated houses.')
+parser.add_argument('--demographic_ratio', default=0.5, type=float, help='Demographic ratio of the generated houses.')
+parser.add_argument('--similarity_threshold', default=0.5, type=float, help='Similarity threshold of the simulation.')
+parser.add_argument('--repeats', default=3, type=int, help='Number of timed runs of every case.')
+parser.add_argument('--seed', default=0, type=int, help='Random seed for the houses and the moves.')
+parser.add_argument('--output', default=None, type=str, help='JSON file for the results, hot_paths-<commit>.json by default.')
+parser.add_argument('--compare', default=None, type=str, help='Earlier results file to compare the new timings against.')
+
+
+def synthetic_polygon(shape, size):
+    # A polygon that holds about size lattice points.
+    if shape == "square":
+        side = (np.sqrt(size) - 1) * SPACING
+        return box(0, 0, side, side)
+    return Point(0, 0).buffer(np.sqrt(size / np.pi) * SPACING, quad_segs=64)
+
+
+def polygon_tiles(polygon, tiles=16):
+    # The polygon cut into a grid of pieces, a stand-in for the many polygons
+    # of a real shape file.
+    minx, miny, maxx, maxy = polygon.bounds
+    xs = np.linspace(minx, maxx, tiles + 1)
+    ys = np.linspace(miny, maxy, tiles + 1)
+    pieces = [
+        polygon.intersection(box(xs[i], ys[j], xs[i + 1], ys[j + 1]))
+        for i in range(tiles)
+        for j in range(tiles)
+    ]
+    return gp.GeoDataFrame(geometry=[piece for piece in pieces if piece.area > 0])
+
+
+def timed(function, repeats, before=None):
+    # Best and median wall time of repeated calls; before runs untimed ahead
+    # of every call.
+    times = []
+    for _ in range(repeats):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": float(np.median(times)), "repeats": repeats}
+
+
+def git_commit():
+    directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=directory, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = bool(subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=directory, capture_output=True, text=True, check=True,
+        ).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def case_key(result):
+    return tuple((name, result.get(name)) for name in ("case", "shape", "houses", "variant"))
+
+
+def run_shape(args, shape, size, shape_file, results):
+    def record(case, timing, variant=None):
+        result = {"case": case, "shape": shape, "houses": number_of_houses, "size": size, "variant": variant, **timing}
+        results.append(result)
+        print(f"{shape:>6} {number_of_houses:>10} {case:<36} {variant or '':<16} {timing['median']:.4f} s", flush=True)
+
+    polygon = synthetic_polygon(shape, size)
+    shapes = gp.GeoDataFrame(geometry=[polygon])
+    np.random.seed(args.seed)
+    houses = populate_simulation(shapes, SPACING, args.empty_ratio, args.demographic_ratio)
+    number_of_houses = len(houses)
+
+    record("generate_points", timed(lambda: generate_points(polygon, SPACING), args.repeats))
+    record("populate_simulation", timed(
+        lambda: populate_simulation(shapes, SPACING, args.empty_ratio, args.demographic_ratio), args.repeats
+    ))
+
+    for engine in args.engines:
+        for incremental in (False, True) if engine == "kdtree" else (False,):
+            variant = f"{engine}-incremental" if incremental else engine
+
+            def setup():
+                sim = Simulation(houses, shape_file, SPACING, args.similarity_threshold, engine, incremental=incremental)
+                sim.configure()
+                return sim
+
+            record("Simulation.configure (setup)", timed(setup, args.repeats), variant)
+            sim = setup()
+            sim.update()
+            empty_houses, unsatisfied_agents, _ = sim.get_unsatisfied_and_empty_agents()
+            np.random.seed(args.seed)
+            satisfied_agents, new_empty_houses = move_centralized(unsatisfied_agents, empty_houses)
+            if not incremental:
+                record("Simulation.update", timed(sim.update, args.repeats), variant)
+                record("get_unsatisfied_and_empty_agents", timed(sim.get_unsatisfied_and_empty_agents, args.repeats), variant)
+                record("Simulation.configure (moves)", timed(
+                    lambda: sim.configure(new_empty_houses, satisfied_agents), args.repeats
+                ), variant)
+            else:
+                # An update after a late iteration, where about one in a
+                # hundred houses changes, the case the incremental mode is for.
+                movers = max(number_of_houses // 200, 1)
+                late_satisfied, late_empty = move_centralized(unsatisfied_agents[:movers], empty_houses[:movers])
+                moved = []
+
+                def apply_moves():
+                    moved.append(setup())
+                    moved[-1].update()
+                    moved[-1].configure(late_empty, late_satisfied)
+
+                record("Simulation.update (late iteration)", timed(lambda: moved[-1].update(), args.repeats, apply_moves), variant)
+
+    record("move_centralized", timed(
+        lambda: move_centralized(unsatisfied_agents, empty_houses), args.repeats
+    ))
+    # Every worker holds a slice of the movers, the root none.
+    workers = args.number_of_partitions
+    record("move_distributed", timed(
+        lambda: move_distributed(
+            [None] + np.array_split(unsatisfied_agents, workers),
+            [None] + np.array_split(empty_houses, workers),
+        ),
+        args.repeats,
+    ))
+
+    for kind in args.partitions:
+        if kind not in ("hilbert_balanced", "morton_balanced", "rcb") and number_of_houses > args.partition_max_houses:
+            continue
+        record("partition_data (agents)", timed(
+            lambda: partition_houses(houses, args.number_of_partitions, kind), args.repeats
+        ), kind)
+
+
+def run_shape_partitions(args, shape, results):
+    # Shape file partitions do not depend on the number of houses.
+    tiles = polygon_tiles(synthetic_polygon(shape, 1_000_000))
+    for kind in args.partitions:
+        timing = timed(lambda: partition_data(tiles, args.number_of_partitions, kind, "shape"), args.repeats)
+        results.append({"case": "partition_data (shape)", "shape": shape, "houses": None, "size": None, "variant": kind, **timing})
+        print(f"{shape:>6} {'':>10} {'partition_data (shape)':<36} {kind:<16} {timing['median']:.4f} s", flush=True)
+
+
+def compare(results, filename):
+    with open(filename) as f:
+        earlier = {case_key(result): result for result in json.load(f)["results"]}
+    print(f"\nCompared with {filename} (median seconds, new / old):")
+    for result in results:
+        old = earlier.get(case_key(result))
+        if old is None:
+            continue
+        ratio = result["median"] / old["median"]
+        flag = "  slower" if ratio > 1.1 else ""
+        print(f"{result['shape']:>6} {result['houses'] or '':>10} {result['case']:<36} {result['variant'] or '':<16} "
+              f"{old['median']:.4f} -> {result['median']:.4f} ({ratio:.2f}x){flag}")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    commit, dirty = git_commit()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for shape in args.shapes:
+            for size in args.sizes:
+                # Simulation reads its polygons from a file
+                shape_file = os.path.join(directory, f"{shape}-{size}.gpkg")
+                gp.GeoDataFrame(geometry=[synthetic_polygon(shape, size)], crs="EPSG:3857").to_file(shape_file)
+                run_shape(args, shape, size, shape_file, results)
+            run_shape_partitions(args, shape, results)
+
+    output = args.output or f"hot_paths-{(commit or 'unknown')[:12]}.json"
+    with open(output, "w") as f:
+        json.dump({
+            "commit": commit,
+            "dirty": dirty,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "machine": {
+                "node": platform.node(),
+                "processor": platform.processor(),
+                "cpus": os.cpu_count(),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "scipy": scipy.__version__,
+                "shapely": shapely.__version__,
+                "geopandas": gp.__version__,
+            },
+            "settings": vars(args),
+            "results": results,
+        }, f, indent=2)
+    print(f"\nResults written to {output}")
+    if args.compare:
+        compare(results, args.compare)
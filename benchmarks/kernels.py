@@ -0,0 +1,50 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from houses import EMPTY
+from kernels import BACKENDS, available_backend
+from simulation import neighbour_graph, neighbourhood_radius
+
+parser = argparse.ArgumentParser(description='Compare the neighbour counting kernels of the kdtree engine.')
+parser.add_argument('--side', default=1000, type=int, help='Houses per side of the square grid of houses.')
+parser.add_argument('--races', default=2, type=int, help='Number of races.')
+parser.add_argument('--empty_ratio', default=0.1, type=float, help='Share of empty houses.')
+parser.add_argument('--threads', default=1, type=int, help='Threads every backend counts with.')
+parser.add_argument('--number_of_iterations', default=10, type=int, help='Number of counts to time per backend.')
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+    spacing = 1.0
+    grid = np.stack(np.meshgrid(np.arange(args.side), np.arange(args.side)), axis=-1)
+    coordinates = grid.reshape(-1, 2) * spacing
+    graph = neighbour_graph(coordinates, neighbourhood_radius(spacing))
+    race = rng.integers(0, args.races, len(coordinates)).astype(np.int8)
+    race[rng.random(len(race)) < args.empty_ratio] = EMPTY
+
+    results = {}
+    counts = {}
+    for name in BACKENDS:
+        if available_backend(name) != name:
+            print(f"{name}: not installed, skipped")
+            continue
+        kernels = BACKENDS[name](args.threads)
+        counts[name] = kernels.neighbour_counts(graph, race)  # warm up, compiles numba
+        times = []
+        for _ in range(args.number_of_iterations):
+            start = time.perf_counter()
+            kernels.neighbour_counts(graph, race)
+            times.append(time.perf_counter() - start)
+        results[name] = np.mean(times)
+
+    for name, seconds in results.items():
+        print(f"{name}: {seconds:.4f} seconds per count of {len(race)} houses")
+    if "numba" in results:
+        identical = all(np.array_equal(a, b) for a, b in zip(counts["numpy"], counts["numba"]))
+        print(f"numba is {results['numpy'] / results['numba']:.2f}x numpy, identical counts: {identical}")
@@ -0,0 +1,79 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+MANIFEST = "manifest.json"
+
+
+def iteration_directory(path, iteration):
+    return os.path.join(path, f"iteration-{iteration:06d}")
+
+
+def get_random_state(generators=None):
+    # The global NumPy generator used by the move functions plus any named
+    # Generator objects, as a JSON string that fits in an .npz file.
+    state = {"numpy": np.random.get_state(legacy=False)}
+    state["numpy"]["state"]["key"] = state["numpy"]["state"]["key"].tolist()
+    for name, generator in (generators or {}).items():
+        state[name] = generator.bit_generator.state
+    return json.dumps(state)
+
+
+def set_random_state(random_state, generators=None):
+    state = json.loads(random_state)
+    state["numpy"]["state"]["key"] = np.array(state["numpy"]["state"]["key"], dtype=np.uint32)
+    np.random.set_state(state["numpy"])
+    for name, generator in (generators or {}).items():
+        generator.bit_generator.state = state[name]
+
+
+def save_rank_checkpoint(path, iteration, rank, random_state, **arrays):
+    # Every rank writes its own file; the write goes to a temporary name first
+    # so a crash never leaves a truncated checkpoint behind.
+    directory = iteration_directory(path, iteration)
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(directory, f"rank-{rank:04d}.npz")
+    with open(f"{filename}.tmp", "wb") as f:
+        np.savez(f, iteration=iteration, random_state=random_state, **arrays)
+    os.replace(f"{filename}.tmp", filename)
+    return os.path.basename(filename)
+
+
+def write_manifest(path, iteration, files, settings):
+    # Written by a single process once every rank has saved its file, which
+    # makes this iteration the latest complete checkpoint. Older ones are
+    # removed afterwards.
+    manifest = {
+        "iteration": iteration,
+        "number_of_ranks": len(files),
+        "directory": os.path.basename(iteration_directory(path, iteration)),
+        "files": files,
+        "settings": settings,
+    }
+    filename = os.path.join(path, MANIFEST)
+    with open(f"{filename}.tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(f"{filename}.tmp", filename)
+
+    for name in os.listdir(path):
+        if name.startswith("iteration-") and name != manifest["directory"]:
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+
+def load_manifest(path):
+    filename = os.path.join(path, MANIFEST)
+    if not os.path.exists(filename):
+        raise FileNotFoundError(f"No complete checkpoint found in {path}.")
+    with open(filename) as f:
+        return json.load(f)
+
+
+def load_rank_checkpoint(path, manifest, rank):
+    filename = os.path.join(path, manifest["directory"], manifest["files"][rank])
+    with np.load(filename) as data:
+        arrays = {name: data[name] for name in data.files}
+    random_state = str(arrays.pop("random_state"))
+    arrays.pop("iteration")
+    return arrays, random_state
@@ -0,0 +1,286 @@
+import time
+from functools import wraps
+
+import numpy as np
+from mpi4py import MPI
+from mpi4py.util.dtlib import from_numpy_dtype
+from scipy.spatial import cKDTree
+from utils import plan_moves, split_arrays
+from houses import Houses, EMPTY, RACE_DTYPE, INDEX_DTYPE, MOVE_DTYPE, empty_moves
+from partition import partition_by_curve
+from metrics import Metrics
+
+HALO_TAG = 11
+
+
+class Halo:
+    # Ghost houses a rank needs from its neighbouring partitions. The set of
+    # boundary houses is found once during setup; every iteration only the races
+    # of those houses travel, point to point, between adjacent ranks.
+    def __init__(self, comm, coordinates, radius, threads=1, metrics=None):
+        self.comm = comm
+        self.metrics = Metrics() if metrics is None else metrics
+        rank = comm.Get_rank()
+        if coordinates is None:
+            coordinates = np.empty((0, 2))
+
+        if len(coordinates):
+            bounds = np.concatenate([coordinates.min(axis=0), coordinates.max(axis=0)])
+        else:
+            bounds = None
+        all_bounds = comm.allgather(bounds)
+
+        # Candidate neighbours are ranks whose bounding boxes come within the
+        # radius of ours. The test is symmetric so both sides agree on it.
+        self.neighbours = [
+            other
+            for other, other_bounds in enumerate(all_bounds)
+            if other != rank
+            and bounds is not None
+            and other_bounds is not None
+            and np.all(bounds[:2] <= other_bounds[2:] + radius)
+            and np.all(other_bounds[:2] <= bounds[2:] + radius)
+        ]
+
+        # Offer every neighbour our houses inside its expanded bounding box and
+        # let it keep the ones that are really within the radius of its houses.
+        candidates = {}
+        requests = []
+        for other in self.neighbours:
+            low = all_bounds[other][:2] - radius
+            high = all_bounds[other][2:] + radius
+            inside = np.all((coordinates >= low) & (coordinates <= high), axis=1)
+            candidates[other] = np.flatnonzero(inside)
+            requests.append(
+                comm.isend(coordinates[candidates[other]], dest=other, tag=HALO_TAG)
+            )
+        offered = {other: comm.recv(source=other, tag=HALO_TAG) for other in self.neighbours}
+        MPI.Request.waitall(requests)
+
+        tree = cKDTree(coordinates) if self.neighbours else None
+        wanted = {}
+        requests = []
+        for other in self.neighbours:
+            distance, _ = tree.query(offered[other], distance_upper_bound=radius, workers=threads)
+            wanted[other] = np.flatnonzero(np.isfinite(distance))
+            requests.append(comm.isend(wanted[other], dest=other, tag=HALO_TAG))
+        self.send_slots = {
+            other: candidates[other][comm.recv(source=other, tag=HALO_TAG)]
+            for other in self.neighbours
+        }
+        MPI.Request.waitall(requests)
+
+        # Ghosts from each neighbour occupy one contiguous block, in the order
+        # that neighbour sends them.
+        self.ghost_coordinates = np.concatenate(
+            [np.empty((0, 2))] + [offered[other][wanted[other]] for other in self.neighbours]
+        )
+        counts = [len(wanted[other]) for other in self.neighbours]
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(int)
+        self.ghost_blocks = {
+            other: slice(offsets[i], offsets[i + 1])
+            for i, other in enumerate(self.neighbours)
+        }
+        self.send_buffers = {
+            other: np.empty(len(self.send_slots[other]), dtype=RACE_DTYPE)
+            for other in self.neighbours
+        }
+
+    def exchange(self, race, ghost_race):
+        # Send the current race of our boundary houses and receive the races of
+        # our ghosts straight into ghost_race.
+        with self.metrics.span("halo"):
+            requests = []
+            for other in self.neighbours:
+                requests.append(
+                    self.comm.Irecv(ghost_race[self.ghost_blocks[other]], source=other, tag=HALO_TAG)
+                )
+            for other in self.neighbours:
+                np.take(race, self.send_slots[other], out=self.send_buffers[other])
+                requests.append(
+                    self.comm.Isend(self.send_buffers[other], dest=other, tag=HALO_TAG)
+                )
+            MPI.Request.Waitall(requests)
+        self.metrics.add_bytes(
+            sum(buffer.nbytes for buffer in self.send_buffers.values()), ghost_race.nbytes
+        )
+
+
+def move_alltoallv(comm, unsatisfied_agents, empty_houses, plan_rng, local_rng, metrics=None):
+    # Decentralised counterpart of utils.move_distributed. Ranks only share
+    # how many agents leave and how many houses they vacate; the agents then
+    # travel straight to their new partition in a single Alltoallv.
+    rank = comm.Get_rank()
+    if unsatisfied_agents is None:
+        unsatisfied_agents = empty_moves()
+    if empty_houses is None:
+        empty_houses = empty_moves()
+    vacated_slots = np.concatenate([unsatisfied_agents[:, 1], empty_houses[:, 1]])
+
+    counts = np.array(comm.allgather((len(unsatisfied_agents), len(vacated_slots))))
+    plan = plan_moves(counts[:, 0], counts[:, 1], plan_rng)
+
+    send_counts = plan[rank]
+    receive_counts = plan[:, rank]
+    # Only the races travel, one byte per agent.
+    send_buffer = local_rng.permutation(unsatisfied_agents[:, 0]).astype(RACE_DTYPE)
+    receive_buffer = np.empty(receive_counts.sum(), dtype=RACE_DTYPE)
+    race_type = from_numpy_dtype(RACE_DTYPE)
+    comm.Alltoallv(
+        [send_buffer, (send_counts, _displacements(send_counts)), race_type],
+        [receive_buffer, (receive_counts, _displacements(receive_counts)), race_type],
+    )
+    if metrics is not None:
+        metrics.add_bytes(send_buffer.nbytes, receive_buffer.nbytes)
+
+    # Arriving agents take a random subset of the vacated houses.
+    local_rng.shuffle(vacated_slots)
+    arrived = len(receive_buffer)
+    satisfied_agents = np.column_stack([receive_buffer, vacated_slots[:arrived]]).astype(MOVE_DTYPE)
+    empty_houses = np.column_stack(
+        [np.full(len(vacated_slots) - arrived, EMPTY), vacated_slots[arrived:]]
+    ).astype(MOVE_DTYPE)
+    return satisfied_agents, empty_houses
+
+
+def _displacements(counts):
+    return np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+
+
+def recorded(kind):
+    # Records a gatherv or scatterv of the collectives below as the phase
+    # "<kind>:<name>" in their metrics.
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, name, *args, **kwargs):
+            start = time.perf_counter()
+            result = method(self, name, *args, **kwargs)
+            self.metrics.add_time(f"{kind}:{name}", time.perf_counter() - start)
+            return result
+        return wrapper
+    return decorator
+
+
+class BufferedCollectives:
+    # Per-iteration gathers and scatters of rows through the uppercase, buffer
+    # based interface. Receive buffers are kept between iterations and only
+    # grow, so the loop does not pickle or allocate on the hot path.
+    def __init__(self, comm, root=0, metrics=None):
+        self.comm = comm
+        self.root = root
+        self.metrics = Metrics() if metrics is None else metrics
+        self.is_root = comm.Get_rank() == root
+        self.counts = np.zeros(comm.Get_size(), dtype=np.int64)
+        self.count = np.zeros(1, dtype=np.int64)
+        self.buffers = {}
+
+    def buffer(self, name, rows, columns, dtype=float):
+        buffer = self.buffers.get(name)
+        if (
+            buffer is None
+            or len(buffer) < rows
+            or buffer.shape[1] != columns
+            or buffer.dtype != dtype
+        ):
+            buffer = np.empty((int(1.25 * rows), columns), dtype=dtype)
+            self.buffers[name] = buffer
+        return buffer[:rows]
+
+    @recorded("gather")
+    def gatherv(self, name, array, columns, dtype=float):
+        # Returns the rows of every rank stacked in rank order, and how many
+        # rows came from each rank, on the root. Other ranks get (None, None).
+        if array is None:
+            array = np.empty((0, columns), dtype=dtype)
+        array = np.ascontiguousarray(array, dtype=dtype)
+        self.count[0] = len(array)
+        self.comm.Gather(self.count, self.counts if self.is_root else None, root=self.root)
+        if not self.is_root:
+            self.comm.Gatherv(array, None, root=self.root)
+            self.metrics.add_bytes(array.nbytes, 0)
+            return None, None
+        gathered = self.buffer(name, self.counts.sum(), columns, dtype)
+        sizes = self.counts * columns
+        self.comm.Gatherv(
+            array,
+            [gathered, (sizes, _displacements(sizes)), from_numpy_dtype(gathered.dtype)],
+            root=self.root,
+        )
+        self.metrics.add_bytes(array.nbytes, gathered.nbytes)
+        return gathered, self.counts.copy()
+
+    @recorded("scatter")
+    def scatterv(self, name, arrays, columns, dtype=float):
+        # Sends arrays[rank] from the root to every rank. Ranks that receive no
+        # rows get None, like comm.scatter of None.
+        sending = None
+        if self.is_root:
+            self.counts[:] = [0 if array is None else len(array) for array in arrays]
+            send = self.buffer(f"{name}-send", self.counts.sum(), columns, dtype)
+            offset = 0
+            for array in arrays:
+                if array is not None:
+                    send[offset : offset + len(array)] = array
+                    offset += len(array)
+            sizes = self.counts * columns
+            sending = [send, (sizes, _displacements(sizes)), from_numpy_dtype(send.dtype)]
+        self.comm.Scatter(self.counts if self.is_root else None, self.count, root=self.root)
+        received = self.buffer(name, self.count[0], columns, dtype)
+        self.comm.Scatterv(sending, received, root=self.root)
+        self.metrics.add_bytes(sending[0].nbytes if self.is_root else 0, received.nbytes)
+        return received if len(received) else None
+
+
+class PickleCollectives:
+    # The same interface over the lowercase, pickle based collectives.
+    def __init__(self, comm, root=0, metrics=None):
+        self.comm = comm
+        self.root = root
+        self.metrics = Metrics() if metrics is None else metrics
+
+    # Bytes are those of the arrays, without the pickle framing.
+    @recorded("gather")
+    def gatherv(self, name, array, columns, dtype=float):
+        arrays = self.comm.gather(array, root=self.root)
+        sent = 0 if array is None else array.nbytes
+        if arrays is None:
+            self.metrics.add_bytes(sent, 0)
+            return None, None
+        arrays = [np.empty((0, columns), dtype=dtype) if array is None else array for array in arrays]
+        gathered = np.concatenate(arrays)
+        self.metrics.add_bytes(sent, gathered.nbytes)
+        return gathered, np.array([len(array) for array in arrays])
+
+    @recorded("scatter")
+    def scatterv(self, name, arrays, columns, dtype=float):
+        received = self.comm.scatter(arrays, root=self.root)
+        sent = 0 if arrays is None else sum(array.nbytes for array in arrays if array is not None)
+        self.metrics.add_bytes(sent, 0 if received is None else received.nbytes)
+        return received
+
+
+def rebalance_houses(collectives, houses, cost, number_of_partitions, spacing, root_computes=False):
+    # Moves houses between workers so that each gets an equal share of the
+    # measured work. Every house is weighted by the time per house of the rank
+    # that holds it now, then all houses are cut again along a Hilbert curve
+    # on the root. houses must have every pending move applied; the new
+    # Houses of this rank are returned, or None on a root that does not
+    # compute.
+    rows = None if houses is None else houses.rows()
+    gathered, counts = collectives.gatherv("rebalance-gather", rows, 3, INDEX_DTYPE)
+    costs = collectives.comm.gather(cost, root=collectives.root)
+    arrays = None
+    if gathered is not None:
+        # The curve only needs the order of the houses, so the lattice
+        # indices stand in for the coordinates.
+        partition = partition_by_curve(
+            gathered[:, 1], gathered[:, 2], np.repeat(costs, counts), number_of_partitions, "hilbert"
+        )
+        arrays = split_arrays(
+            np.column_stack([gathered, partition]).astype(INDEX_DTYPE), number_of_partitions, root_computes
+        )
+    received = collectives.scatterv("rebalance", arrays, 3, INDEX_DTYPE)
+    if not root_computes and collectives.comm.Get_rank() == collectives.root:
+        return None
+    return Houses.from_rows(None if received is None else received.copy(), spacing)
+
@@ -0,0 +1,135 @@
+import os
+import shutil
+
+import numpy as np
+from houses import EMPTY
+
+
+def rank_directory(path, rank):
+    return os.path.join(path, f"rank-{rank:04d}")
+
+
+def file_iteration(name):
+    # Iteration in a "chunk-000012.npz" or "coordinates-000012.npy" name.
+    return int(os.path.splitext(name)[0].split("-")[1])
+
+
+def list_files(directory, prefix):
+    return sorted(
+        name
+        for name in os.listdir(directory)
+        if name.startswith(f"{prefix}-") and name.endswith((".npz", ".npy"))
+    )
+
+
+def clear_history(path):
+    # Called once before a fresh run so no rank directories of an earlier run,
+    # possibly with more ranks, are left behind.
+    shutil.rmtree(path, ignore_errors=True)
+
+
+class HistoryWriter:
+    # Streams the races of one rank's houses to disk every `stride` iterations.
+    # Coordinates are written once, and again whenever the houses of the rank
+    # change after a rebalance, named by the first iteration they hold for.
+    # Frames are buffered and
+    # written as one .npz chunk every `chunk_size` frames: the first frame of a
+    # chunk holds every race, the others only the slots whose race changed, so
+    # each chunk can be decoded on its own.
+    def __init__(self, path, rank, coordinates, stride=1, chunk_size=16, start_iteration=0):
+        self.directory = rank_directory(path, rank)
+        self.stride = stride
+        self.chunk_size = chunk_size
+        self.frames = {}
+        self.count = 0
+        self.first_iteration = None
+        self.previous = None
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Chunks are flushed whenever a checkpoint is written, so on resume
+        # every chunk either ends before the checkpoint or starts after it.
+        # The latter are re-run and dropped here.
+        for name in list_files(self.directory, "chunk") + list_files(self.directory, "coordinates"):
+            if file_iteration(name) >= start_iteration:
+                os.remove(os.path.join(self.directory, name))
+        self.rebase(start_iteration, coordinates)
+
+    def rebase(self, iteration, coordinates):
+        # The rank holds different houses from this iteration on.
+        self.flush()
+        np.save(
+            os.path.join(self.directory, f"coordinates-{iteration:06d}.npy"),
+            np.asarray(coordinates, dtype=float),
+        )
+
+    def append(self, iteration, race):
+        if not self.stride or iteration % self.stride:
+            return
+        if self.previous is None:
+            self.first_iteration = iteration
+            self.frames[f"{iteration}-race"] = race.copy()
+        else:
+            changed = np.flatnonzero(race != self.previous)
+            self.frames[f"{iteration}-slots"] = changed.astype(np.int32)
+            self.frames[f"{iteration}-race"] = race[changed]
+        self.previous = race.copy()
+        self.count += 1
+        if self.count == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.previous is None:
+            return
+        filename = os.path.join(self.directory, f"chunk-{self.first_iteration:06d}.npz")
+        with open(f"{filename}.tmp", "wb") as f:
+            np.savez(f, **self.frames)
+        os.replace(f"{filename}.tmp", filename)
+        self.frames = {}
+        self.count = 0
+        self.previous = None
+
+
+def read_history(path):
+    # Yields (iteration, houses) for every stored frame, with houses as the
+    # float [race, x, y] rows of every rank in rank order and NaN for empty
+    # houses, the form the plotting code works on. The order of the rows
+    # changes where the run rebalanced. Only one chunk per rank is held in
+    # memory at a time.
+    directories = sorted(
+        os.path.join(path, name) for name in os.listdir(path) if name.startswith("rank-")
+    )
+    if not directories:
+        return
+    segments = [list_files(directory, "coordinates") for directory in directories]
+    current = None
+
+    for name in list_files(directories[0], "chunk"):
+        # The coordinates of each rank that hold for this chunk
+        wanted = [
+            [segment for segment in rank_segments if file_iteration(segment) <= file_iteration(name)][-1]
+            for rank_segments in segments
+        ]
+        if wanted != current:
+            coordinates = [
+                np.load(os.path.join(directory, segment))
+                for directory, segment in zip(directories, wanted)
+            ]
+            offsets = np.concatenate([[0], np.cumsum([len(c) for c in coordinates])])
+            houses = np.empty((offsets[-1], 3))
+            houses[:, 1:] = np.concatenate(coordinates)
+            race = houses[:, 0]
+            current = wanted
+
+        chunks = [np.load(os.path.join(directory, name)) for directory in directories]
+        iterations = sorted({int(key.split("-")[0]) for key in chunks[0].files})
+        for iteration in iterations:
+            for chunk, start, end in zip(chunks, offsets[:-1], offsets[1:]):
+                values = chunk[f"{iteration}-race"]
+                values = np.where(values == EMPTY, np.nan, values)
+                if f"{iteration}-slots" in chunk.files:
+                    race[start + chunk[f"{iteration}-slots"]] = values
+                else:
+                    race[start:end] = values
+            yield iteration, houses.copy()
+        for chunk in chunks:
+            chunk.close()
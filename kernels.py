@@ -0,0 +1,104 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from houses import EMPTY
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+# Row blocks per thread, so threads that finish early pick up more work.
+BLOCKS_PER_THREAD = 4
+
+
+def count_rows(indptr, indices, race, start, end, same):
+    # Same-race neighbours of the rows start..end of the graph in one pass
+    # over their edges. Every step is a NumPy call that releases the GIL, so
+    # blocks of rows can be counted on several threads at once.
+    first = indptr[start]
+    lengths = np.diff(indptr[start : end + 1])
+    matches = race[indices[first : indptr[end]]] == np.repeat(race[start:end], lengths)
+    running = np.concatenate([[0], np.cumsum(matches)])
+    counts = running[indptr[start + 1 : end + 1] - first] - running[indptr[start:end] - first]
+    same[start:end] = np.where(race[start:end] != EMPTY, counts, 0)
+
+
+class NumpyKernels:
+    # Neighbour counts over the CSR neighbour graph, with one sparse product
+    # per race on a single thread or blocks of rows on a thread pool.
+    name = "numpy"
+
+    def __init__(self, threads=1):
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(threads) if threads > 1 else None
+
+    def neighbour_counts(self, graph, race):
+        # Empty houses are part of the neighbourhood, so the total only depends
+        # on where houses are. Empty houses get no same-race count.
+        total = np.diff(graph.indptr).astype(np.int64)
+        same = np.zeros(len(race), dtype=np.int64)
+        if self.executor is not None:
+            bounds = np.linspace(0, len(race), BLOCKS_PER_THREAD * self.threads + 1).astype(np.int64)
+            list(self.executor.map(
+                lambda start, end: count_rows(graph.indptr, graph.indices, race, start, end, same),
+                bounds[:-1], bounds[1:],
+            ))
+            return same, total
+        for value in np.unique(race[race != EMPTY]):
+            members = race == value
+            np.copyto(same, graph.dot(members.astype(np.int32)), where=members)
+        return same, total
+
+
+if numba is not None:
+
+    @numba.njit(parallel=True, cache=True)
+    def csr_neighbour_counts(indptr, indices, race, empty):
+        # One pass over the rows of the graph that fills both counts. Rows are
+        # independent and shared out over the threads.
+        rows = len(indptr) - 1
+        same = np.zeros(rows, dtype=np.int64)
+        total = np.empty(rows, dtype=np.int64)
+        for row in numba.prange(rows):
+            start, end = indptr[row], indptr[row + 1]
+            total[row] = end - start
+            value = race[row]
+            if value == empty:
+                continue
+            count = 0
+            for k in range(start, end):
+                if race[indices[k]] == value:
+                    count += 1
+            same[row] = count
+        return same, total
+
+
+class NumbaKernels:
+    # The same counts from a compiled, parallel loop over the CSR rows. The
+    # counts are integers, so they match the NumPy backend exactly.
+    name = "numba"
+
+    def __init__(self, threads=1):
+        numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+
+    def neighbour_counts(self, graph, race):
+        return csr_neighbour_counts(graph.indptr, graph.indices, race, EMPTY)
+
+
+BACKENDS = {"numpy": NumpyKernels, "numba": NumbaKernels}
+
+
+def available_backend(name):
+    # The backend that will run for the requested one: numba falls back to
+    # numpy when it is not installed.
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name!r}, use one of {sorted(BACKENDS)}.")
+    if name == "numba" and numba is None:
+        return "numpy"
+    return name
+
+
+def kernel_backend(name="numpy", threads=1):
+    return BACKENDS[available_backend(name)](threads)
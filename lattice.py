@@ -0,0 +1,55 @@
+import numpy as np
+
+# Grid offsets within two cells of the centre, the same neighbourhood as a
+# radius of 2 * spacing. The centre is included and subtracted again per house
+# so that houses sharing a cell still count each other.
+STENCIL = [
+    (dx, dy)
+    for dx in range(-2, 3)
+    for dy in range(-2, 3)
+    if dx * dx + dy * dy <= 4
+]
+
+# Largest distance, in cells, a house may sit from its grid point.
+LATTICE_TOLERANCE = 1e-6
+
+
+class Lattice:
+    def __init__(self, coordinates, spacing):
+        origin = coordinates.min(axis=0) if len(coordinates) else np.zeros(2)
+        offsets = (coordinates - origin) / spacing
+        indices = np.rint(offsets).astype(np.int64)
+        if len(coordinates) and np.abs(offsets - indices).max() > LATTICE_TOLERANCE:
+            raise ValueError(
+                "Houses do not lie on a regular grid with spacing "
+                f"{spacing}, use the kdtree engine instead."
+            )
+        self.origin = origin
+        self.spacing = spacing
+        # Two cells of padding on every side keep the stencil inside the grid.
+        size = indices.max(axis=0) + 1 if len(coordinates) else np.zeros(2, dtype=int)
+        self.shape = tuple(size + 4)
+        self.cells = np.ravel_multi_index(
+            (indices[:, 0] + 2, indices[:, 1] + 2), self.shape
+        )
+        self.shared_cells = bool(len(self.cells)) and np.bincount(self.cells).max() > 1
+        self.grid = np.zeros(self.shape, dtype=np.uint8)
+        self.counts = np.zeros(self.shape, dtype=np.uint8)
+        self.total = self.neighbour_counts(np.ones(len(coordinates), dtype=bool))
+
+    def neighbour_counts(self, members):
+        # Number of neighbours of every house that are in members. The houses
+        # are rasterised and correlated with the stencil as a sum of shifted
+        # views, which keeps every pass over the grid in uint8.
+        grid = self.grid.reshape(-1)
+        if self.shared_cells:
+            grid[:] = np.bincount(self.cells[members], minlength=grid.size)
+        else:
+            grid[:] = 0
+            grid[self.cells[members]] = 1
+        nx, ny = self.shape[0] - 4, self.shape[1] - 4
+        counts = self.counts[2:-2, 2:-2]
+        counts[...] = 0
+        for dx, dy in STENCIL:
+            counts += self.grid[2 + dx : 2 + dx + nx, 2 + dy : 2 + dy + ny]
+        return self.counts.reshape(-1)[self.cells].astype(np.int64) - members
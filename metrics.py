@@ -0,0 +1,149 @@
+import csv
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+# Phases are named "<kind>" or "<kind>:<detail>", e.g. "gather:empty". The kind
+# decides whether a phase is communication, file I/O or compute in the summary.
+COMMUNICATION_PHASES = {"halo", "gather", "scatter", "move", "allgather", "allreduce"}
+IO_PHASES = {"load", "checkpoint", "history"}
+# Totals that span the other phases and are left out of the shares.
+TOTAL_PHASES = {"iteration"}
+FORMATS = ["jsonl", "csv", "none"]
+
+
+def phase_kind(phase):
+    return phase.split(":")[0]
+
+
+class Metrics:
+    # Per-rank record of where the time goes. Phases add up seconds and
+    # counters hold values for the current iteration; every iteration becomes
+    # one JSONL row, or one CSV row per value, in
+    # <path>/rank-XXXX.<format>. Without a path nothing is written, but the
+    # totals are still kept for the summary.
+    def __init__(self, path=None, rank=0, format="jsonl", append=False):
+        self.rank = rank
+        self.format = format
+        self.file = None
+        self.writer = None
+        if path is not None and format != "none":
+            os.makedirs(path, exist_ok=True)
+            filename = os.path.join(path, f"rank-{rank:04d}.{format}")
+            new = not append or not os.path.exists(filename)
+            self.file = open(filename, "w" if new else "a", newline="")
+            if format == "csv":
+                self.writer = csv.writer(self.file)
+                if new:
+                    self.writer.writerow(["rank", "iteration", "metric", "name", "value"])
+        self.iteration = None
+        self.times = defaultdict(float)
+        self.counters = {}
+        self.total_times = defaultdict(float)
+        self.total_bytes = defaultdict(int)
+
+    @contextmanager
+    def span(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+
+    def add_time(self, phase, seconds):
+        self.times[phase] += seconds
+
+    def count(self, name, value):
+        self.counters[name] = int(value)
+
+    def add_bytes(self, sent, received):
+        # Payload bytes of the exchanges of this iteration
+        for name, value in (("bytes_sent", sent), ("bytes_received", received)):
+            self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def start_iteration(self, iteration):
+        self.flush()
+        self.iteration = iteration
+
+    def flush(self):
+        # Writes the current iteration, or the setup before the first one,
+        # and adds it to the totals.
+        if not self.times and not self.counters:
+            return
+        for phase, seconds in self.times.items():
+            self.total_times[phase] += seconds
+        for name in ("bytes_sent", "bytes_received"):
+            self.total_bytes[name] += self.counters.get(name, 0)
+        if self.format == "jsonl" and self.file is not None:
+            self.file.write(json.dumps({
+                "rank": self.rank,
+                "iteration": self.iteration,
+                "time": dict(self.times),
+                "counters": self.counters,
+            }) + "\n")
+        elif self.writer is not None:
+            for metric, values in (("time", self.times), ("counter", self.counters)):
+                for name, value in values.items():
+                    self.writer.writerow([self.rank, self.iteration, metric, name, value])
+        if self.file is not None:
+            self.file.flush()
+        self.times = defaultdict(float)
+        self.counters = {}
+
+    def totals(self):
+        return {"rank": self.rank, "time": dict(self.total_times), "bytes": dict(self.total_bytes)}
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def summarize(totals):
+    # Load imbalance of every phase over the ranks that ran it, as max/mean
+    # of their total seconds, and the share of compute, communication and
+    # file I/O in the time of all ranks together.
+    phases = sorted({phase for total in totals for phase in total["time"]})
+    imbalance = {}
+    for phase in phases:
+        seconds = np.array([total["time"][phase] for total in totals if phase in total["time"]])
+        mean = seconds.mean()
+        imbalance[phase] = {
+            "max": float(seconds.max()),
+            "mean": float(mean),
+            "max/mean": float(seconds.max() / mean) if mean else 1.0,
+        }
+    shares = defaultdict(float)
+    for total in totals:
+        for phase, seconds in total["time"].items():
+            kind = phase_kind(phase)
+            if kind in TOTAL_PHASES:
+                continue
+            if kind in COMMUNICATION_PHASES:
+                shares["communication"] += seconds
+            elif kind in IO_PHASES:
+                shares["io"] += seconds
+            else:
+                shares["compute"] += seconds
+    measured = sum(shares.values()) or 1.0
+    return {
+        "ranks": len(totals),
+        "imbalance": imbalance,
+        "seconds": dict(shares),
+        "share": {kind: seconds / measured for kind, seconds in shares.items()},
+        "bytes": {
+            name: int(sum(total["bytes"].get(name, 0) for total in totals))
+            for name in ("bytes_sent", "bytes_received")
+        },
+    }
+
+
+def write_summary(path, summary):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
@@ -2,8 +2,11 @@ import geopandas as gp
 import numpy as np
 import pandas as pd
 import dask_geopandas
+import shapely
 from shapely.ops import unary_union, split
 from shapely.geometry import LineString, Point
+from utils import load_shape_file, houses_geodataframe
+from partition_cache import shapefile_digest, array_digest, geometries_to_arrays, arrays_to_geometries
 
 def partition_data_by_row_shape(df_shape_file, number_of_partitions):
     intervals = np.linspace(
@@ -170,6 +173,133 @@ def partition_data_by_geohash(df_shape_file, number_of_partitions):
     return df_shape_file_partitioned
 
 
+# Bits per axis of the space filling curve grid, fine enough to give every
+# house its own cell at the spacings we run.
+CURVE_ORDER = 20
+
+
+def grid_cells(x, y, order=CURVE_ORDER):
+    # Integer cells of a 2**order square grid over the bounding box. Both axes
+    # share one scale so the curve does not stretch the map.
+    low = np.array([x.min(), y.min()])
+    extent = max(x.max() - low[0], y.max() - low[1]) or 1.0
+    scale = ((1 << order) - 1) / extent
+    return (
+        ((x - low[0]) * scale).astype(np.int64),
+        ((y - low[1]) * scale).astype(np.int64),
+    )
+
+
+def hilbert_keys(x, y, order=CURVE_ORDER):
+    x, y = grid_cells(x, y, order)
+    n = 1 << order
+    keys = np.zeros(len(x), dtype=np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        keys += s * s * ((3 * rx) ^ ry)
+        flip = rx & ~ry
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s >>= 1
+    return keys
+
+
+def morton_keys(x, y, order=CURVE_ORDER):
+    x, y = grid_cells(x, y, order)
+    keys = np.zeros(len(x), dtype=np.int64)
+    for bit in range(order):
+        keys |= ((x >> bit) & 1) << (2 * bit)
+        keys |= ((y >> bit) & 1) << (2 * bit + 1)
+    return keys
+
+
+def partition_by_curve(x, y, weights, number_of_partitions, curve="hilbert"):
+    # Partition 1..number_of_partitions of every point. Points are ordered
+    # along the curve and cut where the running weight crosses each equal
+    # share of the total.
+    if not len(x):
+        return np.zeros(0, dtype=np.int64)
+    keys = hilbert_keys(x, y) if curve == "hilbert" else morton_keys(x, y)
+    order = np.argsort(keys, kind="stable")
+    weights = np.asarray(weights, dtype=float)[order]
+    before = np.cumsum(weights) - weights
+    total = weights.sum() or 1.0
+    partition = np.empty(len(x), dtype=np.int64)
+    partition[order] = np.minimum(
+        (before * number_of_partitions / total).astype(np.int64), number_of_partitions - 1
+    ) + 1
+    return partition
+
+
+def partition_by_rcb(x, y, weights, number_of_partitions):
+    # Recursive coordinate bisection. Each set of points is split across the
+    # longer side of its bounding box, with the weight shared in proportion to
+    # the partitions on either side, so any number of partitions works.
+    weights = np.asarray(weights, dtype=float)
+    if not weights.sum():
+        weights = np.ones(len(x))
+    partition = np.zeros(len(x), dtype=np.int64)
+    stack = [(np.arange(len(x)), 1, number_of_partitions)]
+    while stack:
+        points, first, count = stack.pop()
+        if count == 1 or len(points) < 2:
+            partition[points] = first
+            continue
+        px, py = x[points], y[points]
+        axis = px if np.ptp(px) >= np.ptp(py) else py
+        order = np.argsort(axis, kind="stable")
+        cumulative = np.cumsum(weights[points][order])
+        lower = count // 2
+        cut = np.searchsorted(cumulative, cumulative[-1] * lower / count)
+        cut = min(max(cut, 1), len(points) - 1)
+        stack.append((points[order[:cut]], first, lower))
+        stack.append((points[order[cut:]], first + lower, count - lower))
+    return partition
+
+
+def partition_points(x, y, weights, number_of_partitions, method):
+    if method == "rcb":
+        return partition_by_rcb(x, y, weights, number_of_partitions)
+    return partition_by_curve(x, y, weights, number_of_partitions, method)
+
+
+# partition_data kinds that run on point coordinates with NumPy, and the
+# method each uses.
+POINT_PARTITIONS = {
+    "hilbert_balanced": "hilbert",
+    "morton_balanced": "morton",
+    "rcb": "rcb",
+}
+
+
+def partition_data_by_points_shape(df_shape_file, number_of_partitions, method):
+    # Houses are laid out evenly, so polygon area stands in for house count.
+    # The area is planar in the units of the shape file, degrees for the
+    # geographic CA file, which is right here since the houses sit on a
+    # lattice in those units. shapely.area computes it without the geographic
+    # CRS warning of GeoSeries.area.
+    points = df_shape_file.geometry.representative_point()
+    df_shape_file_partitioned = gp.GeoDataFrame(df_shape_file.copy())
+    df_shape_file_partitioned["partition"] = partition_points(
+        points.x.to_numpy(), points.y.to_numpy(), shapely.area(df_shape_file.geometry.values),
+        number_of_partitions, method,
+    )
+    return df_shape_file_partitioned
+
+
+def partition_data_by_points_agents(df_agents, number_of_partitions, method):
+    # Balanced by agents: only occupied houses carry weight.
+    df_agents_partitioned = gp.GeoDataFrame(df_agents.copy())
+    df_agents_partitioned["partition"] = partition_points(
+        df_agents.geometry.x.to_numpy(), df_agents.geometry.y.to_numpy(),
+        df_agents.Race.notna().to_numpy(), number_of_partitions, method,
+    )
+    return df_agents_partitioned
+
+
 def partition_data(df, number_of_partitions=4, kind="row", for_="shape"):
     if kind == "row" and for_=="shape":
         return partition_data_by_row_shape(df, number_of_partitions)
@@ -184,4 +314,60 @@ def partition_data(df, number_of_partitions=4, kind="row", for_="shape"):
     if kind == "morton":
         return partition_data_by_morton(df, number_of_partitions)
     if kind == "geohash":
-        return partition_data_by_geohash(df, number_of_partitions)
\ No newline at end of file
+        return partition_data_by_geohash(df, number_of_partitions)
+    if kind in POINT_PARTITIONS and for_=="shape":
+        return partition_data_by_points_shape(df, number_of_partitions, POINT_PARTITIONS[kind])
+    if kind in POINT_PARTITIONS and for_=="agents":
+        return partition_data_by_points_agents(df, number_of_partitions, POINT_PARTITIONS[kind])
+
+
+def partition_shapes(shapefilepath, number_of_partitions=4, kind="row", cache=None):
+    # partition_data of the shapefile as a GeoDataFrame of geometry and
+    # partition, read from the cache when the same shapefile was partitioned
+    # the same way before.
+    if cache is not None:
+        key = cache.key(shapefile_digest(shapefilepath), kind, "shape", number_of_partitions)
+        cached = cache.load(key)
+        if cached is not None:
+            return gp.GeoDataFrame(
+                {"partition": cached["partition"]},
+                geometry=arrays_to_geometries(cached["wkb"], cached["offsets"]),
+            )
+    partitioned = partition_data(
+        load_shape_file(shapefilepath), number_of_partitions, kind=kind, for_="shape"
+    )
+    partitioned = gp.GeoDataFrame(
+        {"partition": partitioned["partition"].to_numpy(dtype=np.int64)},
+        geometry=partitioned.geometry.to_numpy(),
+    )
+    if cache is not None:
+        wkb, offsets = geometries_to_arrays(partitioned.geometry)
+        cache.save(key, wkb=wkb, offsets=offsets, partition=partitioned["partition"].to_numpy())
+    return partitioned
+
+
+def partition_houses(houses, number_of_partitions=4, kind="row", cache=None):
+    # Partition of every one of the Houses, 0 for houses the partitioner
+    # leaves out. The NumPy partitioners run on the arrays directly and are
+    # cheap enough not to cache. The others only look at the coordinates, so
+    # the cache hits whenever the same houses are generated again, whatever
+    # their races.
+    coordinates = houses.coordinates
+    if kind in POINT_PARTITIONS:
+        return partition_points(
+            coordinates[:, 0], coordinates[:, 1], houses.occupied,
+            number_of_partitions, POINT_PARTITIONS[kind],
+        )
+    if cache is not None:
+        key = cache.key(array_digest(coordinates), kind, "agents", number_of_partitions)
+        cached = cache.load(key)
+        if cached is not None:
+            return cached["partition"]
+    df_agents = houses_geodataframe(houses)
+    df_agents["house"] = np.arange(len(houses))
+    partitioned = partition_data(df_agents, number_of_partitions, kind=kind, for_="agents")
+    partition = np.zeros(len(houses), dtype=np.int64)
+    partition[partitioned["house"].to_numpy(dtype=np.int64)] = partitioned["partition"].to_numpy(dtype=np.int64)
+    if cache is not None:
+        cache.save(key, partition=partition)
+    return partition
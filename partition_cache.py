@@ -0,0 +1,72 @@
+import glob
+import hashlib
+import os
+
+import numpy as np
+import shapely
+
+# Bump when a partitioner changes so results of the old code are not reused.
+CACHE_VERSION = 1
+
+
+def shapefile_digest(filename):
+    # Hash of every file that makes up the shapefile (.shp, .shx, .dbf, ...).
+    digest = hashlib.sha256()
+    stem = os.path.splitext(filename)[0]
+    for name in sorted(glob.glob(f"{glob.escape(stem)}.*")):
+        digest.update(os.path.splitext(name)[1].encode())
+        with open(name, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def array_digest(array):
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha256(f"{array.dtype.str}{array.shape}".encode())
+    digest.update(array.data)
+    return digest.hexdigest()
+
+
+def geometries_to_arrays(geometries):
+    # WKB of every geometry concatenated, with offsets, so it fits an .npz
+    # file without pickling.
+    wkb = [bytes(value) for value in shapely.to_wkb(np.asarray(geometries))]
+    offsets = np.concatenate([[0], np.cumsum([len(value) for value in wkb])])
+    return np.frombuffer(b"".join(wkb), dtype=np.uint8), offsets.astype(np.int64)
+
+
+def arrays_to_geometries(wkb, offsets):
+    data = wkb.tobytes()
+    return shapely.from_wkb(
+        [data[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+    )
+
+
+class PartitionCache:
+    # Partition results on disk, one .npz file per key. Keys are hashes of the
+    # input data and the partition settings, so changed inputs simply miss.
+    def __init__(self, path):
+        self.path = path
+
+    def key(self, digest, kind, for_, number_of_partitions):
+        return hashlib.sha256(
+            f"{CACHE_VERSION}-{digest}-{kind}-{for_}-{number_of_partitions}".encode()
+        ).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, f"{key}.npz")
+
+    def load(self, key):
+        filename = self.filename(key)
+        if not os.path.exists(filename):
+            return None
+        with np.load(filename) as data:
+            return {name: data[name] for name in data.files}
+
+    def save(self, key, **arrays):
+        os.makedirs(self.path, exist_ok=True)
+        filename = self.filename(key)
+        with open(f"{filename}.{os.getpid()}.tmp", "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(f"{filename}.{os.getpid()}.tmp", filename)
@@ -1,12 +1,18 @@
 import logging
+import os
 import time
 from mpi4py import MPI
-from simulation import Simulation
-from utils import load_shape_file, populate_simulation, move_distributed
-from partition import partition_data
+from kernels import available_backend
+from simulation import Simulation, Convergence, neighbourhood_radius
+from communication import Halo, move_alltoallv, rebalance_houses, BufferedCollectives, PickleCollectives
+from utils import populate_simulation, move_distributed, first_unique, split_arrays
+from houses import Houses, RACE_DTYPE, INDEX_DTYPE, MOVE_DTYPE, empty_moves
+from history import HistoryWriter, clear_history
+from checkpoint import get_random_state, set_random_state, save_rank_checkpoint, write_manifest, load_manifest, load_rank_checkpoint
+from partition import partition_shapes, partition_houses
+from partition_cache import PartitionCache
+from metrics import FORMATS, Metrics, summarize, write_summary
 import numpy as np
-import pandas as pd
-import json
 import argparse
 import timeout_decorator
 
@@ -15,15 +21,38 @@ parser.add_argument('--shapefilepath', default="shapefiles/CA/CA.shp", type=str,
 parser.add_argument('--spacing', default=0.1, type=float, help='Spacing value for the simulation.')
 parser.add_argument('--empty_ratio', default=0.1, type=float, help='Empty ratio value for the simulation.')
 parser.add_argument('--demographic_ratio', default=0.5, type=float, help='Demographic ratio value for the simulation.')
+parser.add_argument('--races', default=2, type=int, help='Number of races, the demographic ratio is the share of race 0 and the other races split the rest evenly.')
 parser.add_argument('--similarity_threshold', default=0.3, type=float, help='Similarity threshold for the simulation.')
 parser.add_argument('--number_of_processes', default=8, type=int, help='Number of processes for the simulation.')
 parser.add_argument('--number_of_iterations', default=10, type=int, help='Number of iterations for the simulation.')
 parser.add_argument('--shape_file_partition', default="hilbert", type=str, help='Type of shape file partition for the simulation.')
 parser.add_argument('--populated_houses_partition', default="hilbert", type=str, help='Type of populated houses partition for the simulation.')
+parser.add_argument('--engine', default="kdtree", type=str, choices=["kdtree", "lattice"], help='Neighbour counting engine, a KD-tree graph or a stencil over the house grid.')
+parser.add_argument('--incremental', default=False, action=argparse.BooleanOptionalAction, help='Only re-evaluate houses next to slots that changed since the previous iteration, kdtree engine only.')
+parser.add_argument('--backend', default="numpy", type=str, choices=["numpy", "numba"], help='Kernel that counts neighbours over the kdtree graph, numba falls back to numpy when it is not installed.')
+parser.add_argument('--threads_per_rank', default=1, type=int, help='Threads every rank uses for the neighbour search and the neighbour counts.')
+parser.add_argument('--move', default="root", type=str, choices=["root", "alltoallv"], help='Move agents through the root process or directly between workers with Alltoallv.')
+parser.add_argument('--collectives', default="buffer", type=str, choices=["buffer", "pickle"], help='Exchange the per-iteration data with buffer based Gatherv/Scatterv or with pickled gather/scatter.')
+parser.add_argument('--halo', default=True, action=argparse.BooleanOptionalAction, help='Exchange boundary houses with neighbouring partitions so agents see across partition borders.')
+parser.add_argument('--root_computes', default=False, action=argparse.BooleanOptionalAction, help='Let rank 0 run a partition of its own next to coordinating the workers.')
+parser.add_argument('--rebalance_threshold', default=0, type=float, help='Move houses between workers when the slowest worker takes this many times the mean iteration time, 0 disables rebalancing.')
+parser.add_argument('--rebalance_window', default=5, type=int, help='Number of iterations the worker times are averaged over before deciding to rebalance.')
+parser.add_argument('--convergence_threshold', default=None, type=float, help='Stop once the fraction of unsatisfied agents is at or below this value.')
+parser.add_argument('--convergence_plateau', default=0, type=int, help='Stop once the number of unsatisfied agents has not reached a new low for this many iterations, 0 disables it.')
+parser.add_argument('--checkpoint_interval', default=1, type=int, help='Write a checkpoint every this many iterations, 0 disables checkpointing.')
+parser.add_argument('--history_stride', default=1, type=int, help='Record the houses every this many iterations, 0 disables the history.')
+parser.add_argument('--history_chunk_size', default=16, type=int, help='Number of history frames per chunk file.')
+parser.add_argument('--partition_cache', default=True, action=argparse.BooleanOptionalAction, help='Reuse shape file and house partitions from earlier runs with the same inputs.')
+parser.add_argument('--metrics', default="jsonl", type=str, choices=FORMATS, help='Format of the per-iteration timings and counters every rank writes, none only keeps the summary in the log.')
+parser.add_argument('--resume', action='store_true', help='Resume from the latest complete checkpoint in the checkpoint directory.')
 parser.add_argument('--data_path', default="~", type=str, help='Path where the data needs to be stored.')
 parser.add_argument('--timeout', default="~", type=int, help='Timeout for crash failures or network failures detection.')
 
 args = parser.parse_args()
+# Checked before any MPI or population work, a Simulation refusing it on
+# the workers alone would leave the other ranks waiting forever.
+if args.incremental and args.engine != "kdtree":
+    parser.error("--incremental needs the kdtree engine.")
 
 
 ###########################################################################
@@ -33,24 +62,50 @@ shapefilepath = args.shapefilepath
 spacing = args.spacing
 empty_ratio =args.empty_ratio
 demographic_ratio =args.demographic_ratio
+races = args.races
 similarity_threshold = args.similarity_threshold
+engine = args.engine
+incremental = args.incremental
+backend = available_backend(args.backend)
+threads_per_rank = args.threads_per_rank
+halo_exchange = args.halo
+move_mode = args.move
+collectives_mode = args.collectives
+root_computes = args.root_computes
+rebalance_threshold = args.rebalance_threshold
+rebalance_window = args.rebalance_window
+checkpoint_interval = args.checkpoint_interval
+resume = args.resume
+history_stride = args.history_stride
+history_chunk_size = args.history_chunk_size
 number_of_processes = args.number_of_processes
 number_of_iterations = args.number_of_iterations
+# Ranks that run a partition of the simulation
+number_of_workers = number_of_processes if root_computes else number_of_processes - 1
+first_worker = 0 if root_computes else 1
 shape_file_partition = args.shape_file_partition
 populated_houses_partition = args.populated_houses_partition
 data_path = args.data_path
 log_path = f"{data_path}/logs/{args.shape_file_partition}/{args.populated_houses_partition}/{number_of_processes}"
 checkpoint_path = f"{data_path}/checkpoint/{args.shape_file_partition}/{args.populated_houses_partition}/{number_of_processes}"
 plotting_data_storage_path = f"{data_path}/plotting/{args.shape_file_partition}/{args.populated_houses_partition}/{number_of_processes}"
+history_path = f"{plotting_data_storage_path}/history"
+metrics_path = f"{data_path}/metrics/{args.shape_file_partition}/{args.populated_houses_partition}/{number_of_processes}"
+metrics_format = args.metrics
+partition_cache_path = f"{data_path}/cache/partitions"
+partition_cache = PartitionCache(partition_cache_path) if args.partition_cache else None
 timeout = args.timeout
 ###########################################################################
 
 ###########################################################################
 
 @timeout_decorator.timeout(timeout)  # Timeout of 10 seconds
-def worker_task(sim, set_empty_houses, set_satisfied_agents, rank, logger):
+def worker_task(sim, set_empty_houses, set_satisfied_agents, rank, logger, halo=None):
     sim.configure(set_empty_houses, set_satisfied_agents)
     logger.info(f"Rank {rank}: Simulation configured.")
+    if halo is not None:
+        halo.exchange(sim.houses.race, sim.ghost_race)
+        logger.info(f"Rank {rank}: Halo exchanged with ranks {halo.neighbours}.")
     sim.update()
     (
         get_empty_houses,
@@ -78,21 +133,28 @@ if __name__ == "__main__":
 
     comm = MPI.COMM_WORLD
     rank = comm.Get_rank()
+    is_worker = rank >= first_worker
     
     logger = logging.getLogger(f'Process-{rank}')
     logger.setLevel(logging.INFO)
+    os.makedirs(log_path, exist_ok=True)
     fh = logging.FileHandler(f'{log_path}/app-{rank}.log')
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     fh.setFormatter(formatter)
     logger.addHandler(fh)
 
+    # Timings and counters of this rank, one row for the setup and one per
+    # iteration.
+    metrics = Metrics(
+        metrics_path if metrics_format != "none" else None, rank, metrics_format, append=resume
+    )
+
     logger.info("Rank: %s", rank)
     logger.info("Start time: %s seconds", start_time)
     logger.info("MPI Initialized: %s", initialized)
     logging.info(f"Rank {rank}: Simulation settings loaded.")
-    
-    # Storage of important data for plotting and checkpointing purposes.
-    history_gathered_all_houses = []
+    if backend != args.backend:
+        logger.warning(f"Rank {rank}: {args.backend} is not installed, counting neighbours with {backend}.")
     
     # Data which needs to be gathered
     get_agent_houses_populated = None
@@ -101,7 +163,7 @@ if __name__ == "__main__":
     get_houses = None
 
     # Data which needs to be scattered
-    set_new_satisifed_agents = None
+    set_new_satisfied_agents = None
     set_new_empty_houses = None
     set_empty_houses = None
     set_satisfied_agents = None
@@ -109,146 +171,348 @@ if __name__ == "__main__":
     set_agent_houses_populated_partition = None
     
 
-    # Load shape file and partition data on parent node 0
-    start_time_agent_houses_population = time.time()
-    if rank == 0:
-        logging.info(f"Rank {rank}: Loading shape file and partitioning data.")
-        shape_file = load_shape_file(shapefilepath)
-        shape_file_partition = partition_data(
-            shape_file, 
-            number_of_partitions=number_of_processes - 1,
-            kind=shape_file_partition,
-            for_="shape"
+    start_iteration = 0
+    if resume:
+        # Every rank picks up its own houses, pending moves and random state
+        # from the latest complete checkpoint, which keeps the partition layout.
+        manifest = load_manifest(checkpoint_path)
+        if manifest["number_of_ranks"] != comm.Get_size():
+            raise ValueError(
+                f"Checkpoint was written by {manifest['number_of_ranks']} processes, "
+                f"cannot resume it with {comm.Get_size()}."
+            )
+        if manifest["settings"].get("root_computes", False) != root_computes:
+            raise ValueError("Checkpoint was written with a different --root_computes setting.")
+        checkpoint, random_state = load_rank_checkpoint(checkpoint_path, manifest, rank)
+        start_iteration = manifest["iteration"] + 1
+        houses = (
+            Houses(checkpoint["race"], checkpoint["indices"], spacing, checkpoint["origin"])
+            if is_worker
+            else None
         )
-        set_shape_file_partition = [
-            None
-            if i == 0
-            else shape_file_partition[shape_file_partition["partition"] == i]
-            for i in range(number_of_processes)
-        ]
-        geometry = shape_file.geometry.apply(lambda x: np.array(x.exterior.coords[:-1]))
-        
+        set_satisfied_agents = checkpoint["satisfied_agents"]
+        set_empty_houses = checkpoint["empty_houses"]
+        # Older checkpoints have no worker times, their rebalance window
+        # starts again.
+        resumed_load_history = list(checkpoint.get("load_history", []))
+        convergence_state = checkpoint.get("convergence")
+        logger.info(f"Rank {rank}: Resuming from the checkpoint of iteration {manifest['iteration']}.")
+    else:
+        # Load shape file and partition data on parent node 0
+        start_time_agent_houses_population = time.time()
+        if rank == 0:
+            logging.info(f"Rank {rank}: Loading shape file and partitioning data.")
+            partition_start_time = time.time()
+            with metrics.span("partition:shapes"):
+                shape_file_partition = partition_shapes(
+                    shapefilepath,
+                    number_of_partitions=number_of_workers,
+                    kind=shape_file_partition,
+                    cache=partition_cache,
+                )
+            logger.info(f"Rank {rank}: Total Time taken for partitioning the shape file ---> {time.time() - partition_start_time}")
+            set_shape_file_partition = [
+                None
+                if i < first_worker
+                else shape_file_partition[shape_file_partition["partition"] == i + 1 - first_worker]
+                for i in range(number_of_processes)
+            ]
     
-    # Scatter shape file partitions data to the workers(all nodes other than 0) from parent node 0
-    shape_file_partition_scattered = comm.scatter(set_shape_file_partition, root=0)
-    logger.info(f"Rank {rank}: Shape file partition scattered.")
+        # Scatter shape file partitions data to the workers(all nodes other than 0) from parent node 0
+        with metrics.span("scatter:shapes"):
+            shape_file_partition_scattered = comm.scatter(set_shape_file_partition, root=0)
+        logger.info(f"Rank {rank}: Shape file partition scattered.")
     
-    if rank != 0:
-        get_agent_houses_populated = populate_simulation(
-            shape_file_partition_scattered, spacing, empty_ratio, demographic_ratio
-        )
+        if is_worker:
+            with metrics.span("populate"):
+                get_agent_houses_populated = populate_simulation(
+                    shape_file_partition_scattered, spacing, empty_ratio, demographic_ratio, races
+                )
         
-    #Gather all populated partitions on parent node 0
-    agent_houses_populated_gathered = comm.gather(get_agent_houses_populated, root=0)
-    end_time_agent_houses_population = time.time()
-    total_time_agent_houses_population = end_time_agent_houses_population - start_time_agent_houses_population
-    logger.info(f"Rank {rank}: Total Time taken for populating agents ---> {total_time_agent_houses_population}")
-    logger.info(f"Rank {rank}: Shape file partition gathered.")
+        #Gather all populated partitions on parent node 0
+        with metrics.span("gather:populated"):
+            agent_houses_populated_gathered = comm.gather(get_agent_houses_populated, root=0)
+        end_time_agent_houses_population = time.time()
+        total_time_agent_houses_population = end_time_agent_houses_population - start_time_agent_houses_population
+        logger.info(f"Rank {rank}: Total Time taken for populating agents ---> {total_time_agent_houses_population}")
+        logger.info(f"Rank {rank}: Shape file partition gathered.")
     
-    # Partition populated agent data on parent node 0
-    if rank ==0 :
-        logger.info(f"Rank {rank}: Partitioning agent house populated data.")
+        # Partition populated agent data on parent node 0
+        if rank ==0 :
+            logger.info(f"Rank {rank}: Partitioning agent house populated data.")
         
-        agent_houses_populated_gathered = pd.concat(
-            [i for i in agent_houses_populated_gathered if i is not None])
-        logger.info(f"Rank {rank}: Number of agents in Simulation ---> {len(agent_houses_populated_gathered[~pd.isna(agent_houses_populated_gathered.Race)])}")
+            agent_houses_populated_gathered = Houses.concatenate(
+                [i for i in agent_houses_populated_gathered if i is not None])
+            # Shape partitions that share a border both generate its houses
+            agent_houses_populated_gathered = agent_houses_populated_gathered.take(
+                first_unique(agent_houses_populated_gathered.indices)
+            )
+            logger.info(f"Rank {rank}: Number of agents in Simulation ---> {np.count_nonzero(agent_houses_populated_gathered.occupied)}")
     
-        agent_houses_populated_partition = partition_data(
-            agent_houses_populated_gathered, 
-            number_of_partitions=number_of_processes - 1,
-            kind=populated_houses_partition,
-            for_="agents"
-        )
-        set_agent_houses_populated_partition = [
-            None
-            if i == 0
-            else agent_houses_populated_partition[agent_houses_populated_partition["partition"] == i]
-            for i in range(number_of_processes)
-        ]
-    # Scatter populated agents partition to the workers(all nodes other than 0) from parent node 0
-    agent_houses_populated_partition_scattered = comm.scatter(set_agent_houses_populated_partition, root=0)
-    logger.info(f"Rank {rank}: Agent house populated data scattered.")
-    # Initialize the simulation on parent node 0
-    if rank != 0:
+            partition_start_time = time.time()
+            with metrics.span("partition:houses"):
+                agent_houses_populated_partition = partition_houses(
+                    agent_houses_populated_gathered,
+                    number_of_partitions=number_of_workers,
+                    kind=populated_houses_partition,
+                    cache=partition_cache,
+                )
+            logger.info(f"Rank {rank}: Total Time taken for partitioning the houses ---> {time.time() - partition_start_time}")
+            set_agent_houses_populated_partition = split_arrays(
+                np.column_stack([
+                    agent_houses_populated_gathered.rows(), agent_houses_populated_partition
+                ]).astype(INDEX_DTYPE),
+                number_of_workers,
+                root_computes,
+            )
+        # Scatter populated agents partition to the workers(all nodes other than 0) from parent node 0
+        # as [race, i, j] rows
+        with metrics.span("scatter:houses"):
+            houses = comm.scatter(set_agent_houses_populated_partition, root=0)
+        houses = Houses.from_rows(houses, spacing) if is_worker else None
+        logger.info(f"Rank {rank}: Agent house populated data scattered.")
+
+    # Find the boundary houses each worker needs from its neighbouring
+    # partitions. Every rank takes part, a root that does not compute simply
+    # has no houses.
+    halo = None
+    if halo_exchange:
+        coordinates = None if houses is None else houses.coordinates
+        halo = Halo(comm, coordinates, neighbourhood_radius(spacing), threads_per_rank, metrics)
+        logger.info(f"Rank {rank}: Halo neighbours ---> {halo.neighbours}, ghost houses ---> {len(halo.ghost_coordinates)}.")
+
+    # Initialize the simulation on every worker
+    if is_worker:
         sim = Simulation(
-            agent_houses_populated_partition_scattered, shapefilepath, spacing,
-            similarity_threshold
+            houses, shapefilepath, spacing,
+            similarity_threshold, engine, incremental=incremental, backend=backend, threads=threads_per_rank,
+            ghost_coordinates=None if halo is None else halo.ghost_coordinates, metrics=metrics
         )
         logger.info(f"Rank {rank}: Simulation Initialized.")
+
+    # Every worker streams its own houses to disk for plotting, so the root
+    # never holds the history of the whole run.
+    if rank == 0 and not resume:
+        clear_history(history_path)
+    comm.Barrier()
+    history = None
+    if is_worker:
+        history = HistoryWriter(
+            history_path,
+            rank,
+            houses.coordinates,
+            history_stride,
+            history_chunk_size,
+            start_iteration,
+        )
         
-    for i in range(number_of_iterations):
+    # The move plan must be identical on every rank, while the choice of which
+    # agent and which house is made locally.
+    move_seed = comm.bcast(
+        np.random.SeedSequence().entropy if rank == 0 else None, root=0
+    )
+    move_plan_rng = np.random.default_rng(move_seed)
+    move_local_rng = np.random.default_rng([move_seed, rank])
+    generators = {"move_plan": move_plan_rng, "move_local": move_local_rng}
+    if resume:
+        set_random_state(random_state, generators)
+
+    if collectives_mode == "buffer":
+        collectives = BufferedCollectives(comm, metrics=metrics)
+    else:
+        collectives = PickleCollectives(comm, metrics=metrics)
+
+    # Iteration times of the workers since the last rebalance
+    load_history = resumed_load_history if resume else []
+    convergence = Convergence(args.convergence_threshold, args.convergence_plateau)
+    if resume and convergence_state is not None:
+        convergence.restore(str(convergence_state))
+        if convergence.reason is not None:
+            # The checkpointed iteration was the last one
+            logger.info(f"Rank {rank}: Already converged after iteration {start_iteration - 1}, {convergence.reason}.")
+            start_iteration = number_of_iterations
+    for i in range(start_iteration, number_of_iterations):
+        metrics.start_iteration(i)
         logger.info(f"Rank {rank}: Starting iteration {i}")
         iteration_start_time = time.time()
-        if rank != 0:
+        if is_worker:
             try:
                 # Configure the simulation with empty houses and satisified agents
-                get_empty_houses, get_unsatisfied_agents, get_houses = worker_task(sim, set_empty_houses, set_satisfied_agents, rank, logger)
+                get_empty_houses, get_unsatisfied_agents, get_houses = worker_task(sim, set_empty_houses, set_satisfied_agents, rank, logger, halo)
+                metrics.count("houses", len(get_houses))
+                metrics.count("agents", np.count_nonzero(get_houses.occupied))
+                metrics.count("empty_houses", len(get_empty_houses))
+                metrics.count("unsatisfied", len(get_unsatisfied_agents))
                 iteration_end_time_others = time.time()
                 total_iteration_time = iteration_end_time_others - iteration_start_time
-                logger.info(f"Rank {rank}: Total Iteration time: {total_iteration_time} seconds.")
+                # The root logs its whole iteration below
+                logger.info(f"Rank {rank}: Total {'Compute' if rank == 0 else 'Iteration'} time: {total_iteration_time} seconds.")
             except timeout_decorator.timeout_decorator.TimeoutError:
                logger.error(f"Rank {rank}: Worker task exceeded the time limit.")
                break
-        # Gathered data from the workers on the parent node 0
-        gathered_unsatisfied_agents = comm.gather(get_unsatisfied_agents, root=0)
-        gathered_empty_houses = comm.gather(get_empty_houses, root=0)
-        gathered_all_houses = comm.gather(get_houses, root=0)
-        logger.info(f"Rank {rank}: Unsatisfied agents, empty houses and all houses gathered.")
-        
-        # Saving unsatisfied_agents, empty_houses, all_houses data for checkpointing
-        # purposes
-        
-
-        if rank == 0:
-
-            checkpoint_data = {
-                'iteration': i,
-                'unsatisfied_agents': np.concatenate(
-                    [arr for arr in gathered_unsatisfied_agents if arr is not None]
-                ).tolist(),
-                'empty_houses': np.concatenate(
-                    [arr for arr in gathered_empty_houses if arr is not None]
-                ).tolist(),
-                'all_houses': np.concatenate(
-                    [arr for arr in gathered_all_houses if arr is not None]
-                ).tolist(),
-                }
-            out_file = open(f"{checkpoint_path}/checkpoint.json", "w")
-            json.dump(checkpoint_data, out_file)
-            
-        
-        # Save plotting data, calculate new satisfied agents and new empty houses
-        # with the move function.
-        if rank == 0:
-            gathered_all_houses = np.concatenate(
-                [arr for arr in gathered_all_houses if arr is not None]
-            )
+        communication_time = 0
+        if move_mode == "alltoallv":
+            # Workers swap agents directly, without involving the root.
             move_start_time = time.time()
-            set_new_satisfied_agents, set_new_empty_houses = move_distributed(
-                gathered_unsatisfied_agents,
-                gathered_empty_houses,
-                number_of_processes - 1,
-            )
+            with metrics.span("move"):
+                set_satisfied_agents, set_empty_houses = move_alltoallv(
+                    comm,
+                    get_unsatisfied_agents,
+                    get_empty_houses,
+                    move_plan_rng,
+                    move_local_rng,
+                    metrics,
+                )
             move_end_time = time.time()
             total_move_time = move_end_time - move_start_time
             logger.info(f"Rank {rank}: Agents moved.")
             logger.info(f"Rank {rank}: Total Move time: {total_move_time} seconds.")
-            if gathered_all_houses is not None:
-                history_gathered_all_houses.append(gathered_all_houses.tolist() )
-         
-        # Scatter satisfied and empty agents data to all workers from the parent node
-        set_satisfied_agents = comm.scatter(set_new_satisfied_agents, root=0)
-        set_empty_houses = comm.scatter(set_new_empty_houses, root=0)
-        logger.info(f"Rank {rank}: Unsatisfied agents and empty houses scattered.")
+        else:
+            # Gathered data from the workers on the parent node 0
+            communication_start_time = time.time()
+            gathered_unsatisfied_agents, unsatisfied_counts = collectives.gatherv(
+                "unsatisfied", get_unsatisfied_agents, 2, MOVE_DTYPE
+            )
+            gathered_empty_houses, empty_counts = collectives.gatherv(
+                "empty", get_empty_houses, 2, MOVE_DTYPE
+            )
+            communication_time += time.time() - communication_start_time
+            logger.info(f"Rank {rank}: Unsatisfied agents and empty houses gathered.")
+
+        # Save plotting data
+        if history is not None:
+            with metrics.span("history"):
+                history.append(i, get_houses.race)
+
+        if move_mode == "root":
+            # Calculate new satisfied agents and new empty houses with the move
+            # function on the parent node.
+            if rank == 0:
+                move_start_time = time.time()
+                # Planning the moves is compute, the exchange is in the
+                # gather and scatter phases.
+                with metrics.span("move_plan"):
+                    set_new_satisfied_agents, set_new_empty_houses = move_distributed(
+                        np.split(gathered_unsatisfied_agents, np.cumsum(unsatisfied_counts)[:-1]),
+                        np.split(gathered_empty_houses, np.cumsum(empty_counts)[:-1]),
+                        root_computes,
+                    )
+                move_end_time = time.time()
+                total_move_time = move_end_time - move_start_time
+                logger.info(f"Rank {rank}: Agents moved.")
+                logger.info(f"Rank {rank}: Total Move time: {total_move_time} seconds.")
+
+            # Scatter satisfied and empty agents data to all workers from the parent node
+            communication_start_time = time.time()
+            set_satisfied_agents = collectives.scatterv("satisfied", set_new_satisfied_agents, 2, MOVE_DTYPE)
+            set_empty_houses = collectives.scatterv("empty", set_new_empty_houses, 2, MOVE_DTYPE)
+            communication_time += time.time() - communication_start_time
+            logger.info(f"Rank {rank}: Unsatisfied agents and empty houses scattered.")
+        logger.info(f"Rank {rank}: Total Communication time ({collectives_mode}): {communication_time} seconds.")
+
+        # Measure how evenly the work is spread over the workers. The loop is
+        # bulk synchronous, so the slowest worker sets the pace for everyone.
+        with metrics.span("allgather:loads"):
+            loads = np.array(comm.allgather(
+                None if not is_worker else (total_iteration_time, len(sim.houses), np.count_nonzero(sim.houses.occupied))
+            )[first_worker:])
+        load_history.append(loads[:, 0])
+        worker_times = np.mean(load_history[-rebalance_window:], axis=0)
+        if rank == 0:
+            logger.info(f"Rank {rank}: Load imbalance (max/mean) ---> iteration time {loads[:, 0].max() / loads[:, 0].mean()}, agents {loads[:, 2].max() / loads[:, 2].mean()}.")
+        if (
+            rebalance_threshold
+            and len(load_history) >= rebalance_window
+            and worker_times.max() > rebalance_threshold * worker_times.mean()
+        ):
+            # Apply the pending moves, cut the houses again by the time each
+            # one costs and rebuild the halo and the simulation on the new
+            # houses.
+            rebalance_start_time = time.time()
+            cost = 0.0
+            if is_worker:
+                sim.configure(set_empty_houses, set_satisfied_agents)
+                cost = worker_times[rank - first_worker] / max(len(sim.houses), 1)
+            houses = rebalance_houses(
+                collectives, sim.houses if is_worker else None, cost, number_of_workers, spacing, root_computes
+            )
+            set_satisfied_agents = None
+            set_empty_houses = None
+            if halo_exchange:
+                halo = Halo(comm, None if houses is None else houses.coordinates, neighbourhood_radius(spacing), threads_per_rank, metrics)
+            if is_worker:
+                sim = Simulation(
+                    houses, shapefilepath, spacing,
+                    similarity_threshold, engine, incremental=incremental, backend=backend, threads=threads_per_rank,
+                    ghost_coordinates=None if halo is None else halo.ghost_coordinates, metrics=metrics
+                )
+                sim.configure()
+                history.rebase(i + 1, houses.coordinates)
+            load_history = []
+            logger.info(f"Rank {rank}: Rebalanced, number of houses ---> {0 if houses is None else len(houses)}.")
+            logger.info(f"Rank {rank}: Total Rebalance time: {time.time() - rebalance_start_time} seconds.")
+
+        # Every rank sees the same global counts, so all of them stop together
+        agent_counts = np.zeros(2, dtype=np.int64)
+        if is_worker:
+            agent_counts[:] = len(get_unsatisfied_agents), np.count_nonzero(get_houses.occupied)
+        with metrics.span("allreduce"):
+            comm.Allreduce(MPI.IN_PLACE, agent_counts, op=MPI.SUM)
+        if rank == 0:
+            logger.info(f"Rank {rank}: Unsatisfied agents ---> {agent_counts[0]} of {agent_counts[1]}.")
+        converged = convergence.update(*agent_counts)
+
+        # Every rank writes its houses, the moves it still has to apply and its
+        # random state in parallel. The root then records the checkpoint as
+        # complete in the manifest.
+        if checkpoint_interval and (i + 1) % checkpoint_interval == 0:
+            checkpoint_start_time = time.time()
+            if history is not None:
+                with metrics.span("history"):
+                    history.flush()
+            with metrics.span("checkpoint"):
+                checkpoint_file = save_rank_checkpoint(
+                    checkpoint_path,
+                    i,
+                    rank,
+                    get_random_state(generators),
+                    race=sim.houses.race if is_worker else np.empty(0, dtype=RACE_DTYPE),
+                    indices=sim.houses.indices if is_worker else np.empty((0, 2), dtype=INDEX_DTYPE),
+                    origin=sim.houses.origin if is_worker else np.zeros(2),
+                    satisfied_agents=empty_moves() if set_satisfied_agents is None else set_satisfied_agents,
+                    empty_houses=empty_moves() if set_empty_houses is None else set_empty_houses,
+                    load_history=np.array(load_history[-rebalance_window:]).reshape(-1, number_of_workers),
+                    convergence=convergence.state(),
+                )
+                checkpoint_files = comm.gather(checkpoint_file, root=0)
+                if rank == 0:
+                    write_manifest(checkpoint_path, i, checkpoint_files, vars(args))
+            logger.info(f"Rank {rank}: Total Checkpoint time: {time.time() - checkpoint_start_time} seconds.")
         if rank ==0:
             iteration_end_time_0 = time.time()
             total_iteration_time = iteration_end_time_0 - iteration_start_time
             logger.info(f"Rank {rank}: Total Iteration time: {total_iteration_time} seconds.")
+        metrics.add_time("iteration", time.time() - iteration_start_time)
+
+        if converged:
+            logger.info(f"Rank {rank}: Converged after iteration {i}, {convergence.reason}.")
+            break
     
     # Save plotting data
+    if history is not None:
+        with metrics.span("history"):
+            history.flush()
+
+    # Summary of where the time went over all ranks
+    metrics.close()
+    totals = comm.gather(metrics.totals(), root=0)
     if rank == 0:
-        out_file = open(f"{plotting_data_storage_path}/history_gathered_all_houses.json", "w")
-        json.dump(history_gathered_all_houses, out_file)
+        summary = summarize(totals)
+        if metrics_format != "none":
+            write_summary(metrics_path, summary)
+        for phase, imbalance in summary["imbalance"].items():
+            logger.info(f"Rank {rank}: Load imbalance of {phase} (max/mean) ---> {imbalance['max/mean']}.")
+        logger.info(f"Rank {rank}: Time share ---> {summary['share']}, bytes ---> {summary['bytes']}.")
     if initialized:
         MPI.Finalize()
     
@@ -1,10 +1,14 @@
 import logging
+import os
 import time
-from simulation import Simulation
+from kernels import available_backend
+from simulation import Simulation, Convergence
 from utils import load_shape_file, populate_simulation, move_centralized
+from houses import Houses
+from history import HistoryWriter, clear_history
+from checkpoint import get_random_state, set_random_state, save_rank_checkpoint, write_manifest, load_manifest, load_rank_checkpoint
+from metrics import FORMATS, Metrics, summarize, write_summary
 import numpy as np
-import pandas as pd
-import json
 import argparse
 
 
@@ -13,14 +17,31 @@ parser.add_argument('--shapefilepath', default="shapefiles/CA/CA.shp", type=str,
 parser.add_argument('--spacing', default=0.1, type=float, help='Spacing value for the simulation.')
 parser.add_argument('--empty_ratio', default=0.1, type=float, help='Empty ratio value for the simulation.')
 parser.add_argument('--demographic_ratio', default=0.5, type=float, help='Demographic ratio value for the simulation.')
+parser.add_argument('--races', default=2, type=int, help='Number of races, the demographic ratio is the share of race 0 and the other races split the rest evenly.')
 parser.add_argument('--similarity_threshold', default=0.3, type=float, help='Similarity threshold for the simulation.')
 parser.add_argument('--number_of_iterations', default=10, type=int, help='Number of iterations for the simulation.')
+parser.add_argument('--engine', default="kdtree", type=str, choices=["kdtree", "lattice"], help='Neighbour counting engine, a KD-tree graph or a stencil over the house grid.')
+parser.add_argument('--incremental', default=False, action=argparse.BooleanOptionalAction, help='Only re-evaluate houses next to slots that changed since the previous iteration, kdtree engine only.')
+parser.add_argument('--backend', default="numpy", type=str, choices=["numpy", "numba"], help='Kernel that counts neighbours over the kdtree graph, numba falls back to numpy when it is not installed.')
+parser.add_argument('--threads_per_rank', default=1, type=int, help='Threads every rank uses for the neighbour search and the neighbour counts.')
+parser.add_argument('--population_processes', default=1, type=int, help='Number of local processes that generate the houses, 0 uses every core.')
+parser.add_argument('--convergence_threshold', default=None, type=float, help='Stop once the fraction of unsatisfied agents is at or below this value.')
+parser.add_argument('--convergence_plateau', default=0, type=int, help='Stop once the number of unsatisfied agents has not reached a new low for this many iterations, 0 disables it.')
 parser.add_argument('--data_path', default="~", type=str, help='Path where the data needs to be stored.')
+parser.add_argument('--checkpoint_interval', default=1, type=int, help='Write a checkpoint every this many iterations, 0 disables checkpointing.')
+parser.add_argument('--history_stride', default=1, type=int, help='Record the houses every this many iterations, 0 disables the history.')
+parser.add_argument('--history_chunk_size', default=16, type=int, help='Number of history frames per chunk file.')
+parser.add_argument('--metrics', default="jsonl", type=str, choices=FORMATS, help='Format of the per-iteration timings and counters, none only keeps the summary in the log.')
+parser.add_argument('--resume', action='store_true', help='Resume from the latest complete checkpoint in the checkpoint directory.')
 
 if __name__ == "__main__":
     start_time = time.time()  # Start time of the program
 
     args = parser.parse_args()
+    # Checked before the houses are populated rather than when the
+    # Simulation is built.
+    if args.incremental and args.engine != "kdtree":
+        parser.error("--incremental needs the kdtree engine.")
         
 
     ###########################################################################
@@ -30,30 +51,47 @@ if __name__ == "__main__":
     spacing = args.spacing
     empty_ratio =args.empty_ratio
     demographic_ratio =args.demographic_ratio
+    races = args.races
     similarity_threshold = args.similarity_threshold
+    engine = args.engine
+    incremental = args.incremental
+    backend = available_backend(args.backend)
+    threads_per_rank = args.threads_per_rank
+    population_processes = args.population_processes or os.cpu_count()
     number_of_iterations = args.number_of_iterations
     data_path = args.data_path
+    checkpoint_interval = args.checkpoint_interval
+    resume = args.resume
+    history_stride = args.history_stride
+    history_chunk_size = args.history_chunk_size
     log_path = f"{data_path}/logs/{spacing}"
     checkpoint_path = f"{data_path}/checkpoint/{spacing}"
     plotting_data_storage_path = f"{data_path}/plotting/{spacing}"
+    history_path = f"{plotting_data_storage_path}/history"
+    metrics_path = f"{data_path}/metrics/{spacing}"
+    metrics_format = args.metrics
     ###########################################################################
 
     ###########################################################################
     
     logger = logging.getLogger('Process-Central')
     logger.setLevel(logging.INFO)
+    os.makedirs(log_path, exist_ok=True)
     fh = logging.FileHandler(f'{log_path}/Central.log')
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     fh.setFormatter(formatter)
     logger.addHandler(fh)
 
+    # Timings and counters, one row for the setup and one per iteration
+    metrics = Metrics(
+        metrics_path if metrics_format != "none" else None, 0, metrics_format, append=resume
+    )
+
     logger.info("Start time: %s seconds", start_time)
     logging.info("Central: Simulation settings loaded.")
+    if backend != args.backend:
+        logger.warning(f"Central: {args.backend} is not installed, counting neighbours with {backend}.")
     
-    # Storage of important data for plotting and checkpointing purposes.
-    history_all_houses = []
-
-
     # Data which needs to be scattered
     
     set_empty_houses = None
@@ -61,31 +99,70 @@ if __name__ == "__main__":
     
     
 
-    # Load shape file and partition data on parent node 0
-    logging.info("Central: Loading shape file data.")
-    shape_file = load_shape_file(shapefilepath)
-    geometry = shape_file.geometry.apply(lambda x: np.array(x.exterior.coords[:-1]))
+    start_iteration = 0
+    if resume:
+        # Pick up the houses, pending moves and random state of the latest
+        # complete checkpoint.
+        manifest = load_manifest(checkpoint_path)
+        checkpoint, random_state = load_rank_checkpoint(checkpoint_path, manifest, 0)
+        set_random_state(random_state)
+        start_iteration = manifest["iteration"] + 1
+        agent_houses_populated = Houses(
+            checkpoint["race"], checkpoint["indices"], spacing, checkpoint["origin"]
+        )
+        set_satisfied_agents = checkpoint["satisfied_agents"]
+        set_empty_houses = checkpoint["empty_houses"]
+        convergence_state = checkpoint.get("convergence")
+        logger.info(f"Central: Resuming from the checkpoint of iteration {manifest['iteration']}.")
+    else:
+        # Load shape file and partition data on parent node 0
+        logging.info("Central: Loading shape file data.")
+        shape_file = load_shape_file(shapefilepath)
+        geometry = shape_file.geometry.apply(lambda x: np.array(x.exterior.coords[:-1]))
 
-    # Scatter shape file partitions data to the workers(all nodes other than 0) from parent node 0
+        # Scatter shape file partitions data to the workers(all nodes other than 0) from parent node 0
 
-    start_time_agent_houses_population = time.time()
-    agent_houses_populated = populate_simulation(
-        shape_file, spacing, empty_ratio, demographic_ratio
-    )
-    end_time_agent_houses_population = time.time()
-    total_time_agent_houses_population = end_time_agent_houses_population - start_time_agent_houses_population
-    logger.info("Central: Populate Simulation.")
-    logger.info(f"Central: Number of agents in Simulation ---> {len(agent_houses_populated[~pd.isna(agent_houses_populated.Race)])}")
-    logger.info(f"Central: Total Time taken for populating agents ---> {total_time_agent_houses_population}")
+        start_time_agent_houses_population = time.time()
+        with metrics.span("populate"):
+            agent_houses_populated = populate_simulation(
+                shape_file, spacing, empty_ratio, demographic_ratio,
+                races=races, processes=population_processes
+            )
+        end_time_agent_houses_population = time.time()
+        total_time_agent_houses_population = end_time_agent_houses_population - start_time_agent_houses_population
+        logger.info("Central: Populate Simulation.")
+        logger.info(f"Central: Number of agents in Simulation ---> {np.count_nonzero(agent_houses_populated.occupied)}")
+        logger.info(f"Central: Total Time taken for populating agents ---> {total_time_agent_houses_population}")
     # Initialize the simulation on parent node 0
     
     sim = Simulation(
             agent_houses_populated, shapefilepath, spacing,
-            similarity_threshold
+            similarity_threshold, engine, incremental=incremental, backend=backend, threads=threads_per_rank,
+            metrics=metrics
         )
     logger.info("Central: Simulation Initialized.")
+
+    # Houses are streamed to disk for plotting as the simulation runs
+    if not resume:
+        clear_history(history_path)
+    history = HistoryWriter(
+        history_path,
+        0,
+        agent_houses_populated.coordinates,
+        history_stride,
+        history_chunk_size,
+        start_iteration,
+    )
+    convergence = Convergence(args.convergence_threshold, args.convergence_plateau)
+    if resume and convergence_state is not None:
+        convergence.restore(str(convergence_state))
+        if convergence.reason is not None:
+            # The checkpointed iteration was the last one
+            logger.info(f"Central: Already converged after iteration {start_iteration - 1}, {convergence.reason}.")
+            start_iteration = number_of_iterations
         
-    for i in range(number_of_iterations):
+    for i in range(start_iteration, number_of_iterations):
+        metrics.start_iteration(i)
         logger.info(f"Central: Starting iteration {i}")
 
         
@@ -101,42 +178,67 @@ if __name__ == "__main__":
             houses,
         ) = sim.get_unsatisfied_and_empty_agents()
         logger.info("Central: Simulation Updated.")
+        metrics.count("houses", len(houses))
+        metrics.count("agents", np.count_nonzero(houses.occupied))
+        metrics.count("empty_houses", len(empty_houses))
+        metrics.count("unsatisfied", len(unsatisfied_agents))
                 
-        # Saving unsatisfied_agents, empty_houses, all_houses data for checkpointing
-        # purposes
-        
-        
-        checkpoint_data = {
-                'iteration': i,
-                'unsatisfied_agents':unsatisfied_agents.tolist(),
-                'empty_houses':empty_houses.tolist(),
-                'all_houses':houses.tolist(),
-                }
-        out_file = open(f"{checkpoint_path}/checkpoint.json", "w")
-        json.dump(checkpoint_data, out_file)
-            
-        
         # Save plotting data, calculate new satisified agents and new empty houses
         # with the move function.
         
-        set_satisfied_agents, set_empty_houses = move_centralized(
-                unsatisfied_agents,
-                empty_houses,
-            )
+        with metrics.span("move_plan"):
+            set_satisfied_agents, set_empty_houses = move_centralized(
+                    unsatisfied_agents,
+                    empty_houses,
+                )
         logger.info("Central: Agents moved.")
-        if houses is not None:
-            history_all_houses.append(houses.tolist())
+        with metrics.span("history"):
+            history.append(i, houses.race)
+
+        number_of_agents = np.count_nonzero(houses.occupied)
+        logger.info(f"Central: Unsatisfied agents ---> {len(unsatisfied_agents)} of {number_of_agents}.")
+        converged = convergence.update(len(unsatisfied_agents), number_of_agents)
+
+        # Save the houses, the moves still to be applied, the random state and
+        # the convergence state
+        if checkpoint_interval and (i + 1) % checkpoint_interval == 0:
+            with metrics.span("history"):
+                history.flush()
+            with metrics.span("checkpoint"):
+                checkpoint_file = save_rank_checkpoint(
+                    checkpoint_path,
+                    i,
+                    0,
+                    get_random_state(),
+                    race=houses.race,
+                    indices=houses.indices,
+                    origin=houses.origin,
+                    satisfied_agents=set_satisfied_agents,
+                    empty_houses=set_empty_houses,
+                    convergence=convergence.state(),
+                )
+                write_manifest(checkpoint_path, i, [checkpoint_file], vars(args))
+            logger.info("Central: Checkpoint saved.")
          
         # Scatter satisfied and empty agents data to all workers from the parent node
        
         iteration_end_time = time.time()
         total_iteration_time = iteration_end_time - iteration_start_time
+        metrics.add_time("iteration", total_iteration_time)
         logger.info(f"Central: Total Iteration time: {total_iteration_time} seconds.")
+
+        if converged:
+            logger.info(f"Central: Converged after iteration {i}, {convergence.reason}.")
+            break
     
-    # Save plotting data
-    
-    out_file = open(f"{plotting_data_storage_path}/history_gathered_all_houses.json", "w")
-    json.dump(history_all_houses, out_file)
+    with metrics.span("history"):
+        history.flush()
+
+    metrics.close()
+    summary = summarize([metrics.totals()])
+    if metrics_format != "none":
+        write_summary(metrics_path, summary)
+    logger.info(f"Central: Time share ---> {summary['share']}.")
     
     end_time = time.time()  # End time of the program
     
@@ -1,95 +1,274 @@
-from utils import load_shape_file
+import json
+from utils import load_shape_file, houses_array
+from houses import Houses, EMPTY, RACE_DTYPE, MOVE_DTYPE
+from lattice import Lattice
+from kernels import kernel_backend
+from metrics import Metrics
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy.sparse import csr_matrix
 from scipy.spatial import cKDTree
-from collections import defaultdict
+
+# Incremental updates fall back to counting every house when more than this
+# fraction of the slots changed since the previous update.
+INCREMENTAL_LIMIT = 0.1
+
+
+def neighbourhood_radius(spacing):
+    # Houses sit on a grid of the given spacing and the neighbourhood reaches
+    # two cells out. The radius is padded slightly so grid neighbours exactly
+    # 2 * spacing away are not lost to rounding in the generated coordinates.
+    return spacing * 2 * (1 + 1e-6)
+
+
+def strip_pairs(coordinates, radius, threads):
+    # query_pairs split over threads. The houses are sorted along x and cut
+    # into one strip per thread; each thread searches its strip plus the houses
+    # just right of it and keeps the pairs whose first house in that order lies
+    # in its strip, so every pair is found exactly once. cKDTree releases the
+    # GIL while it searches.
+    order = np.lexsort((np.arange(len(coordinates)), coordinates[:, 0]))
+    x = coordinates[order, 0]
+    bounds = np.linspace(0, len(coordinates), threads + 1).astype(np.int64)
+
+    def strip(start, end):
+        if start == end:
+            return np.empty((0, 2), dtype=np.int64)
+        # Twice the radius leaves room for rounding in the distances
+        stop = np.searchsorted(x, x[end - 1] + 2 * radius, side="right")
+        members = order[start:stop]
+        pairs = cKDTree(coordinates[members]).query_pairs(radius, output_type="ndarray")
+        return members[pairs[pairs.min(axis=1) < end - start]]
+
+    with ThreadPoolExecutor(threads) as executor:
+        return np.concatenate(list(executor.map(strip, bounds[:-1], bounds[1:])))
+
+
+def neighbour_graph(coordinates, radius, threads=1):
+    # Symmetric CSR adjacency over house slots. House coordinates never change
+    # during a run, so this is built once and reused by every iteration.
+    if threads > 1:
+        pairs = strip_pairs(coordinates, radius, threads)
+    else:
+        pairs = cKDTree(coordinates).query_pairs(radius, output_type="ndarray")
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    return csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, cols)),
+        shape=(len(coordinates), len(coordinates)),
+    )
 
 
 class Simulation:
-    def __init__(self, houses, shapefilepath, spacing, similarity_threshold):
+    def __init__(
+        self,
+        houses,
+        shapefilepath,
+        spacing,
+        similarity_threshold,
+        engine="kdtree",
+        ghost_coordinates=None,
+        incremental=False,
+        backend="numpy",
+        threads=1,
+        metrics=None,
+    ):
+        if engine not in ("kdtree", "lattice"):
+            raise ValueError(f"Unknown engine {engine!r}, use 'kdtree' or 'lattice'.")
+        if incremental and engine != "kdtree":
+            raise ValueError("Incremental updates need the neighbour graph of the kdtree engine.")
         self.initial_houses = houses
         self.houses = None
         self.shapefilepath = shapefilepath
         self.similarity_threshold = similarity_threshold
         self.spacing = spacing
-        self.geometry = None
+        self.shape_geometry = None
         self.unsatisfied_agents = None
         self.unsatisfied_agents_index = []
+        self.engine = engine
+        # Counts neighbours over the graph of the kdtree engine
+        self.threads = threads
+        self.kernels = kernel_backend(backend, threads)
+        self.metrics = Metrics() if metrics is None else metrics
+        self.graph = None
+        self.lattice = None
+        # Ghosts are houses owned by neighbouring partitions. They take part in
+        # the neighbourhood of our houses but are never evaluated or moved here.
+        if ghost_coordinates is None:
+            ghost_coordinates = np.empty((0, 2))
+        self.ghost_coordinates = ghost_coordinates
+        self.ghost_race = np.full(len(ghost_coordinates), EMPTY, dtype=RACE_DTYPE)
+        # Incremental mode keeps the same-race counts and satisfaction of every
+        # slot between updates, plus the slots moved since the last update
+        # with the race they held before.
+        self.incremental = incremental
+        self.same = None
+        self.total = None
+        self.unsatisfied = None
+        self.previous_ghost_race = None
+        self.moved_slots = []
+        self.moved_race = []
 
-    def configure(self, empty_houses=None, satisfied_agents=None):
-        self.geometry = list(
-            load_shape_file(self.shapefilepath).geometry.apply(
-                lambda x: np.array(x.exterior.coords[:-1])
-            )
-        )
+    @property
+    def geometry(self):
+        # The polygons of the shape file. Nothing in the simulation needs
+        # them, so they are only loaded when asked for, and a rebalance that
+        # builds a new Simulation does not read the shape file again.
+        if self.shape_geometry is None:
+            with self.metrics.span("load"):
+                self.shape_geometry = list(
+                    load_shape_file(self.shapefilepath).geometry.apply(
+                        lambda x: np.array(x.exterior.coords[:-1])
+                    )
+                )
+        return self.shape_geometry
 
+    def configure(self, empty_houses=None, satisfied_agents=None):
+        # self.houses holds a fixed set of house slots. Moves arrive as
+        # [race, slot] rows and only rewrite the race of those slots.
         if self.houses is None:
-            self.houses = np.array(
-                [
-                    self.initial_houses.Race,
-                    self.initial_houses.geometry.x,
-                    self.initial_houses.geometry.y,
-                ],
-                dtype=float,
-            ).T
-        if empty_houses is not None:
-            self.houses = np.vstack([self.houses, empty_houses])
-
-        if satisfied_agents is not None:
-            self.houses = np.vstack([self.houses, satisfied_agents])
-
-    def is_unsatisfied(self, agent, all_neighbours, race_list):
-        neighbours_indices = all_neighbours[agent]
-        race = race_list[agent]
-        if np.isnan(race):
-            return False
-        neighbours = race_list[neighbours_indices]
-        if len(neighbours) == 0:
-            return False
-        else:
-            return (
-                len(neighbours[neighbours == race]) / len(neighbours)
-                < self.similarity_threshold
-            )
+            with self.metrics.span("tree_build"):
+                if isinstance(self.initial_houses, Houses):
+                    self.houses = self.initial_houses.copy()
+                else:
+                    self.houses = houses_array(self.initial_houses, self.spacing)
+                coordinates = np.vstack([self.houses.coordinates, self.ghost_coordinates])
+                if self.engine == "lattice":
+                    self.lattice = Lattice(coordinates, self.spacing)
+                else:
+                    self.graph = neighbour_graph(
+                        coordinates, neighbourhood_radius(self.spacing), self.threads
+                    )
 
-    def populate_unsatisfied_agents(
-        self, index, all_neighbours, race_list, agent_houses
-    ):
-        if self.is_unsatisfied(index, all_neighbours, race_list):
-            self.unsatisfied_agents_index.append(index)
-            self.unsatisfied_agents = np.append(
-                self.unsatisfied_agents,
-                [[race_list[index], agent_houses[index][0], agent_houses[index][1]]],
-                axis=0,
-            )
-
-            return 1
-        else:
-            return 0
+        with self.metrics.span("configure"):
+            for moves in (empty_houses, satisfied_agents):
+                if moves is not None:
+                    slots = moves[:, 1].astype(np.int64)
+                    if self.incremental:
+                        self.moved_slots.append(slots)
+                        self.moved_race.append(self.houses.race[slots])
+                    self.houses.race[slots] = moves[:, 0]
+
+    def neighbour_counts(self, race):
+        # Empty houses are part of the neighbourhood, so the total only depends
+        # on where houses are. The lattice takes one stencil pass per race.
+        if self.engine != "lattice":
+            return self.kernels.neighbour_counts(self.graph, race)
+        same = np.zeros(len(race), dtype=np.int64)
+        for value in np.unique(race[race != EMPTY]):
+            members = race == value
+            np.copyto(same, self.lattice.neighbour_counts(members), where=members)
+        return same, self.lattice.total
+
+    def changed_slots(self, race):
+        # Slots moved since the last update, ghosts included, with the race
+        # each held at that update. A slot moved twice keeps its first race.
+        slots = np.concatenate([np.empty(0, dtype=np.int64)] + self.moved_slots)
+        before = np.concatenate([np.empty(0, dtype=RACE_DTYPE)] + self.moved_race)
+        ghosts = np.flatnonzero(self.ghost_race != self.previous_ghost_race)
+        slots = np.concatenate([slots, len(self.houses) + ghosts])
+        before = np.concatenate([before, self.previous_ghost_race[ghosts]])
+        slots, first = np.unique(slots, return_index=True)
+        return slots, before[first]
+
+    def apply_changes(self, race, slots, before):
+        # Brings the same-race counts up to date from the changed slots alone
+        # and returns every slot whose satisfaction may have changed. Totals
+        # only depend on where houses are and never change.
+        rows = self.graph[slots]
+        neighbours = rows.indices
+        source = np.repeat(np.arange(len(slots)), np.diff(rows.indptr))
+        neighbour_race = race[neighbours]
+        occupied = neighbour_race != EMPTY
+        gained = (neighbour_race == race[slots][source]) & occupied
+        lost = (neighbour_race == before[source]) & occupied
+
+        # Neighbours that kept their race lose the old race of a changed slot
+        # and gain its new one.
+        kept = ~np.isin(neighbours, slots)
+        np.add.at(self.same, neighbours[kept], gained[kept].astype(np.int64) - lost[kept])
+        # Changed slots are counted again from the current races around them.
+        self.same[slots] = np.bincount(source, weights=gained, minlength=len(slots))
+        return np.union1d(slots, neighbours)
+
+    def satisfaction(self, race, same, total):
+        # Houses without neighbours are always satisfied.
+        similarity = np.divide(same, total, out=np.full(len(race), np.inf), where=total > 0)
+        return (similarity < self.similarity_threshold) & (race != EMPTY)
 
     def update(self):
-        old_houses = self.houses[:, [1, 2]].copy()
-        race = self.houses[:, 0].copy()
-        all_neighbours = defaultdict(list)
-        tree = cKDTree(old_houses)
-        for i, j in tree.query_pairs(self.spacing * 2):
-            all_neighbours[i].append(j)
-            all_neighbours[j].append(i)
-        changes = 0
-        self.unsatisfied_agents = np.empty((0, 3))
-        self.unsatisfied_agents_index = []
-        for index in np.arange(len(old_houses)):
-            changes += self.populate_unsatisfied_agents(
-                index,
-                all_neighbours,
-                race,
-                old_houses,
-            )
+        with self.metrics.span("satisfaction"):
+            race = np.concatenate([self.houses.race, self.ghost_race])
+            slots = None
+            if self.incremental and self.same is not None:
+                slots, before = self.changed_slots(race)
+                if len(slots) > INCREMENTAL_LIMIT * len(race):
+                    slots = None
+            if slots is None:
+                self.same, self.total = self.neighbour_counts(race)
+                self.unsatisfied = self.satisfaction(race, self.same, self.total)
+            else:
+                affected = self.apply_changes(race, slots, before)
+                self.unsatisfied[affected] = self.satisfaction(
+                    race[affected], self.same[affected], self.total[affected]
+                )
+            if self.incremental:
+                self.moved_slots = []
+                self.moved_race = []
+                self.previous_ghost_race = self.ghost_race.copy()
+
+            unsatisfied = self.unsatisfied[: len(self.houses)]
+            self.unsatisfied_agents_index = np.flatnonzero(unsatisfied)
+            self.unsatisfied_agents = np.column_stack(
+                [race[self.unsatisfied_agents_index], self.unsatisfied_agents_index]
+            ).astype(MOVE_DTYPE)
 
     def get_unsatisfied_and_empty_agents(self):
-        empty_houses = self.houses[np.isnan(self.houses[:, 0])]
-        old_houses = self.houses.copy()
-    
-        self.houses = np.delete(self.houses,self.unsatisfied_agents_index,axis=0)
-        self.houses = self.houses[~np.isnan(self.houses[:, 0])]
-       
-        return empty_houses, self.unsatisfied_agents, old_houses
+        # Movers are returned as [race, slot] rows. The houses are returned as
+        # they are; they are only rewritten by the next call to configure.
+        with self.metrics.span("satisfaction"):
+            empty_slots = np.flatnonzero(self.houses.race == EMPTY)
+            empty_houses = np.column_stack(
+                [self.houses.race[empty_slots], empty_slots]
+            ).astype(MOVE_DTYPE)
+            return empty_houses, self.unsatisfied_agents, self.houses
+
+
+class Convergence:
+    # Decides when a run can stop early from the number of unsatisfied agents
+    # after each update. threshold stops once the unsatisfied fraction is at
+    # or below it, plateau once the count has not reached a new low for that
+    # many iterations. Both are off by default.
+    def __init__(self, threshold=None, plateau=0):
+        self.threshold = threshold
+        self.plateau = plateau
+        self.lowest = None
+        self.stale = 0
+        self.reason = None
+
+    def update(self, unsatisfied, agents):
+        fraction = unsatisfied / agents if agents else 0.0
+        if self.threshold is not None and fraction <= self.threshold:
+            self.reason = f"unsatisfied fraction {fraction} is at most {self.threshold}"
+            return True
+        if self.lowest is None or unsatisfied < self.lowest:
+            self.lowest = unsatisfied
+            self.stale = 0
+        else:
+            self.stale += 1
+        if self.plateau and self.stale >= self.plateau:
+            self.reason = f"no fewer unsatisfied agents for {self.plateau} iterations"
+            return True
+        return False
+
+    def state(self):
+        # Saved with every checkpoint so a resumed run stops after the same
+        # iteration. reason is set once the run has converged.
+        lowest = None if self.lowest is None else int(self.lowest)
+        return json.dumps({"lowest": lowest, "stale": self.stale, "reason": self.reason})
+
+    def restore(self, state):
+        state = json.loads(state)
+        self.lowest = state["lowest"]
+        self.stale = state["stale"]
+        self.reason = state["reason"]
@@ -1,11 +1,14 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import geopandas as gp
 import numpy as np
 import pandas as pd
-from shapely.geometry import Point
+import shapely
+from shapely.geometry import box
 import dask_geopandas
 from geopandas.tools import sjoin
 from shapely.ops import unary_union
-from shapely.prepared import prep
+from houses import Houses, EMPTY, MOVE_DTYPE
 
 
 
@@ -19,16 +22,53 @@ def load_shape_file(filename):
 
 
 
-def generate_points(polygon, spacing):
+def lattice_range(polygon, spacing):
+    # Lattice columns and rows spanned by the bounding box of the polygon.
     (minx, miny, maxx, maxy) = polygon.bounds
-    x_coords = np.arange(np.floor(minx), np.ceil(maxx), spacing)
-    y_coords = np.arange(np.floor(miny), np.ceil(maxy), spacing)
-    grid_x, grid_y = np.meshgrid(x_coords, y_coords)
-    points = np.column_stack([grid_x.ravel(), grid_y.ravel()])
-    prepared_polygon = prep(polygon)
-    mask = np.array([prepared_polygon.intersects(Point(x, y)) for x, y in points])
-    points_within_polygon = [Point(x, y) for x, y in points[mask]]
-    return points_within_polygon
+    i_coords = np.arange(np.floor(minx / spacing), np.ceil(maxx / spacing) + 1, dtype=np.int64)
+    j_coords = np.arange(np.floor(miny / spacing), np.ceil(maxy / spacing) + 1, dtype=np.int64)
+    return i_coords, j_coords
+
+
+def grid_indices(polygon, spacing, tile_size=2**20, rows=None):
+    # Integer (i, j) indices of the points (i * spacing, j * spacing) inside or
+    # on the boundary of the polygon, in row major order. Every polygon uses
+    # this same global lattice, so houses of neighbouring polygons line up and
+    # shared ones have identical indices. The grid is tested a block of rows at
+    # a time, at most about tile_size points, so the full meshgrid of a large
+    # polygon never exists at once. Blocks whose bounding box lies completely
+    # inside or outside the polygon skip the per point test. rows, a slice
+    # of the lattice rows, restricts the search to part of the polygon.
+    i_coords, j_coords = lattice_range(polygon, spacing)
+    if rows is not None:
+        j_coords = j_coords[rows]
+    if tile_size is None:
+        block = max(len(j_coords), 1)
+    else:
+        block = max(tile_size // len(i_coords), 1)
+    shapely.prepare(polygon)
+
+    indices = [np.empty((0, 2), dtype=np.int64)]
+    for start in range(0, len(j_coords), block):
+        grid_i, grid_j = np.meshgrid(i_coords, j_coords[start : start + block])
+        grid_i, grid_j = grid_i.ravel(), grid_j.ravel()
+        tile = box(
+            i_coords[0] * spacing, grid_j[0] * spacing,
+            i_coords[-1] * spacing, grid_j[-1] * spacing,
+        )
+        if polygon.contains(tile):
+            mask = slice(None)
+        elif not polygon.intersects(tile):
+            continue
+        else:
+            mask = shapely.intersects_xy(polygon, grid_i * spacing, grid_j * spacing)
+        indices.append(np.column_stack([grid_i[mask], grid_j[mask]]))
+    return np.concatenate(indices)
+
+
+def generate_points(polygon, spacing, tile_size=2**20):
+    # Coordinates of the lattice points in the polygon as an (n, 2) array.
+    return grid_indices(polygon, spacing, tile_size) * spacing
 
 
 def random_population(size, ratio):
@@ -38,6 +78,44 @@ def random_population(size, ratio):
     return samples
 
 
+def race_shares(demographic_ratio, races):
+    # Share of the agents of every race. A single ratio is the share of race
+    # 0 with the rest split evenly over the other races; a sequence gives the
+    # share of each race.
+    if np.ndim(demographic_ratio):
+        shares = np.asarray(demographic_ratio, dtype=float)
+        if len(shares) != races:
+            raise ValueError(f"Expected {races} demographic ratios, got {len(shares)}.")
+        return shares / shares.sum()
+    if races < 2:
+        raise ValueError("The simulation needs at least two races.")
+    return np.concatenate([[demographic_ratio], np.full(races - 1, (1 - demographic_ratio) / (races - 1))])
+
+
+def random_races(size, shares):
+    # Exactly round(size * share) agents of every race, in random order. Races
+    # are laid out from the highest down before shuffling, so two races give
+    # the same draw as random_population.
+    bounds = np.rint(size * np.cumsum(shares[::-1])).astype(np.int64)
+    counts = np.diff(np.concatenate([[0], np.minimum(bounds, size)]))
+    counts[-1] = size - counts[:-1].sum()
+    samples = np.repeat(np.arange(len(shares) - 1, -1, -1), counts)
+    np.random.shuffle(samples)
+    return samples
+
+
+def first_unique(indices):
+    # Positions of the first occurrence of every distinct lattice point, in
+    # their original order. Repeats come from borders shared by two polygons.
+    if not len(indices):
+        return np.arange(0)
+    low = indices.min(axis=0)
+    keys = (indices[:, 0] - low[0]) * (indices[:, 1].max() - low[1] + 1) + indices[:, 1] - low[1]
+    _, first = np.unique(keys, return_index=True)
+    first.sort()
+    return first
+
+
 def populate_simulation(
     shape_file: gp.GeoDataFrame,
     spacing: float,
@@ -45,42 +123,85 @@ def populate_simulation(
     demographic_ratio: float,
     races=2,
     random_seed=None,
+    processes=1,
+    tile_size=2**20,
 ):
+    # Returns the Houses on the global lattice of the given spacing.
     if random_seed is not None:
         np.random.seed(random_seed)
-    all_points = []
-    for polygon in shape_file.geometry:
-        all_points.extend(generate_points(polygon, spacing))
-    
-    data = [{'geometry': point, 'Race': None} for point in all_points]
+    if processes > 1:
+        # Polygons are cut into blocks of lattice rows of about tile_size
+        # points, so one large polygon is spread over the pool as well. The
+        # blocks come back in order and the houses are the same as in serial.
+        polygons, blocks = [], []
+        for polygon in shape_file.geometry:
+            i_coords, j_coords = lattice_range(polygon, spacing)
+            block = max(tile_size // len(i_coords), 1)
+            for start in range(0, len(j_coords), block):
+                polygons.append(polygon)
+                blocks.append(slice(start, start + block))
+        with ProcessPoolExecutor(processes) as executor:
+            parts = list(
+                executor.map(
+                    grid_indices, polygons, repeat(spacing), repeat(tile_size), blocks,
+                    chunksize=max(len(blocks) // (4 * processes), 1),
+                )
+            )
+    else:
+        parts = [grid_indices(polygon, spacing, tile_size) for polygon in shape_file.geometry]
+    indices = np.concatenate([np.empty((0, 2), dtype=np.int64)] + parts)
+    indices = indices[first_unique(indices)]
 
-    all_houses = gp.GeoDataFrame(data, geometry='geometry')
-    all_houses = all_houses.drop_duplicates(["geometry"])
-    occupied = random_population(size=len(all_houses), ratio=1 - empty_ratio)
+    shares = race_shares(demographic_ratio, races)
+    houses = Houses(np.full(len(indices), EMPTY), indices, spacing)
+    occupied = random_population(size=len(houses), ratio=1 - empty_ratio)
     # calculate the sum once and use it later
     total_occupied = int(occupied.sum())
-    race = random_population(size=total_occupied, ratio=1 - demographic_ratio)
-    all_houses.loc[occupied, 'Race'] = race.astype(int)
-    return all_houses[['Race', 'geometry']]
+    houses.race[occupied] = random_races(total_occupied, shares)
+    return houses
+
+
+def houses_array(houses, spacing):
+    # Houses of a GeoDataFrame with a Race column, NaN for empty houses.
+    return Houses.from_coordinates(
+        houses.Race.to_numpy(dtype=float),
+        np.column_stack([houses.geometry.x, houses.geometry.y]),
+        spacing,
+    )
 
 
-def split_arrays(array, number_of_partitions):
+def houses_geodataframe(houses):
+    # The GeoDataFrame form of Houses, with NaN for empty houses, for
+    # plotting, export and the GeoDataFrame based partitioners.
+    coordinates = houses.coordinates
+    return gp.GeoDataFrame(
+        {"Race": np.where(houses.occupied, houses.race, np.nan)},
+        geometry=gp.points_from_xy(coordinates[:, 0], coordinates[:, 1]),
+    )
+
+
+def split_arrays(array, number_of_partitions, root_computes=False):
+    # Partition p goes to rank p, or to rank p - 1 when the root runs a
+    # partition of its own.
     if array.size==0:
-        return [None]*(number_of_partitions+1)
-    masks = [array[:, 3] == value for value in range(1, number_of_partitions + 1)]
+        return [None]*(number_of_partitions + (0 if root_computes else 1))
+    # The partition id is always the last column
+    masks = [array[:, -1] == value for value in range(1, number_of_partitions + 1)]
 
     # Split the array based on the masks
-    split_arrays = [array[mask][:, 0:3] for mask in masks]
+    split_arrays = [array[mask][:, :-1] for mask in masks]
+    if root_computes:
+        return split_arrays
     # Adding None because we don't need any data for the root node.
     return [None] + split_arrays
 
 
-def move_distributed(unsatisfied_agents, empty_houses, number_of_partitions=4):
+def move_distributed(unsatisfied_agents, empty_houses, root_computes=False):
     satisfied_agents = []
 
     concatenated_empty_house = np.concatenate(
     [
-        np.hstack([empty_houses[i], np.full((empty_houses[i].shape[0], 1), i)])
+        np.hstack([empty_houses[i], np.full((empty_houses[i].shape[0], 1), i, dtype=MOVE_DTYPE)])
         for i in range(len(empty_houses)) if empty_houses[i] is not None
     ],
     axis=0
@@ -88,7 +209,7 @@ def move_distributed(unsatisfied_agents, empty_houses, number_of_partitions=4):
 
     concatenated_unsatisfied_agents = np.concatenate(
         [
-            np.hstack([unsatisfied_agents[i], np.full((unsatisfied_agents[i].shape[0], 1), i)])
+            np.hstack([unsatisfied_agents[i], np.full((unsatisfied_agents[i].shape[0], 1), i, dtype=MOVE_DTYPE)])
             for i in range(len(unsatisfied_agents)) if unsatisfied_agents[i] is not None
         ],
         axis=0
@@ -97,9 +218,18 @@ def move_distributed(unsatisfied_agents, empty_houses, number_of_partitions=4):
     everything = np.concatenate((concatenated_unsatisfied_agents, concatenated_empty_house),axis=0)
     np.random.shuffle(everything[:, 0])
 
-    satisfied_agents = everything[~np.isnan(everything[:,0])]
-    concatenated_empty_house = everything[np.isnan(everything[:,0])]
-    return split_arrays(satisfied_agents, number_of_partitions), split_arrays(concatenated_empty_house, number_of_partitions)
+    satisfied_agents = everything[everything[:,0] != EMPTY]
+    concatenated_empty_house = everything[everything[:,0] == EMPTY]
+    # The last column is the rank the rows came from. Rank ids are shifted by
+    # one when the root computes so split_arrays hands rank 0 its own rows.
+    if root_computes:
+        satisfied_agents[:, -1] += 1
+        concatenated_empty_house[:, -1] += 1
+    number_of_partitions = len(unsatisfied_agents) - (0 if root_computes else 1)
+    return (
+        split_arrays(satisfied_agents, number_of_partitions, root_computes),
+        split_arrays(concatenated_empty_house, number_of_partitions, root_computes),
+    )
             
 
 
@@ -109,7 +239,21 @@ def move_centralized(unsatisfied_agents, empty_houses):
     everything = np.concatenate((unsatisfied_agents, empty_houses),axis=0)
     np.random.shuffle(everything[:, 0])
     
-    satisfied_agents = everything[~np.isnan(everything[:,0])]
-    empty_houses = everything[np.isnan(everything[:,0])]
+    satisfied_agents = everything[everything[:,0] != EMPTY]
+    empty_houses = everything[everything[:,0] == EMPTY]
+
+    return satisfied_agents, empty_houses
 
-    return satisfied_agents, empty_houses
\ No newline at end of file
+def plan_moves(agent_counts, vacated_counts, rng):
+    # Number of unsatisfied agents every partition sends to every other one.
+    # Drawing the destinations of each partition's agents in turn, without
+    # replacement from the vacated houses that are still free, gives the same
+    # distribution as shuffling all movers together. The plan only depends on
+    # the counts and the generator, so every rank can compute it on its own.
+    vacated_counts = np.asarray(vacated_counts, dtype=np.int64)
+    plan = np.zeros((len(agent_counts), len(vacated_counts)), dtype=np.int64)
+    free = vacated_counts.copy()
+    for source, count in enumerate(agent_counts):
+        plan[source] = rng.multivariate_hypergeometric(free, count)
+        free -= plan[source]
+    return plan